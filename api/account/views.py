@@ -1,16 +1,13 @@
 from rest_framework.response import Response
 from rest_framework import status
 from dj_rest_auth.registration.views import RegisterView
-from chat.models import Setting
+from chat.config import settings_cache
 from allauth.account import app_settings as allauth_account_settings
 
 
 class RegistrationView(RegisterView):
     def create(self, request, *args, **kwargs):
-        try:
-            open_registration = Setting.objects.get(name='open_registration').value == 'True'
-        except Setting.DoesNotExist:
-            open_registration = True
+        open_registration = settings_cache.get('open_registration', 'True') == 'True'
 
         if open_registration is False:
             return Response({'detail': 'Registration is not yet open.'}, status=status.HTTP_403_FORBIDDEN)
@@ -1,6 +1,9 @@
+import json
+
 from django.contrib import admin
 
 from .models import Conversation, Message, Setting
+from .snapshots import load_snapshot
 
 
 @admin.register(Conversation)
@@ -17,6 +20,13 @@ class MessageAdmin(admin.ModelAdmin):
 
     get_conversation_topic.short_description = 'Conversation Topic'
 
+    readonly_fields = ('get_prompt',)
+
+    def get_prompt(self, obj):
+        return json.dumps(load_snapshot(obj), ensure_ascii=False, indent=2)
+
+    get_prompt.short_description = 'Prompt'
+
 
 @admin.register(Setting)
 class SettingAdmin(admin.ModelAdmin):
@@ -0,0 +1,63 @@
+"""
+Cached Setting values
+
+The settings are read on every chat request, so every process keeps them in
+memory for LOCAL_SECONDS. A save is only seen by the process that made it
+right away, the other processes may serve the old values for up to
+LOCAL_SECONDS, with or without Redis.
+
+When REDIS_URL is set, the values are also kept in the shared cache, for
+SHARED_SECONDS or until a Setting is saved or deleted (see chat/signals.py),
+so a process refreshing its copy rarely hits the database. Without REDIS_URL
+the cache is per process and is not used, every refresh reads the table.
+"""
+import time
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Setting
+
+LOCAL_SECONDS = 5
+SHARED_SECONDS = 300
+CACHE_KEY = 'chat:settings'
+
+
+class SettingsCache:
+    """name to value of all the Setting rows"""
+
+    def __init__(self, local_seconds=LOCAL_SECONDS, shared_seconds=SHARED_SECONDS, shared=None):
+        self.local_seconds = local_seconds
+        self.shared_seconds = shared_seconds
+        self.shared = bool(settings.REDIS_URL) if shared is None else shared
+        self._values = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def all(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._values is not None and now - self._loaded_at < self.local_seconds:
+                return self._values
+        values = cache.get(CACHE_KEY) if self.shared else None
+        if values is None:
+            # the first row of a name wins, like Setting.objects.filter(name=...).first()
+            values = dict(Setting.objects.order_by('-pk').values_list('name', 'value'))
+            if self.shared:
+                cache.set(CACHE_KEY, values, self.shared_seconds)
+        with self._lock:
+            self._values, self._loaded_at = values, now
+        return values
+
+    def get(self, name, default=None):
+        return self.all().get(name, default)
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+        if self.shared:
+            cache.delete(CACHE_KEY)
+
+
+settings_cache = SettingsCache()
@@ -0,0 +1,82 @@
+"""
+Set-based deletion of everything a user has of a kind
+
+Rows are deleted with QuerySet.delete() in batches of primary keys, each
+batch in its own transaction, so the delete signals run: they remove the store
+directories. The composite stores go first, so the signal of a context message
+finds no store left to invalidate. The large text columns are not loaded for
+the signals.
+"""
+import logging
+
+from django.db import transaction
+
+from .models import Conversation, ConversationStore, EmbeddingDocument, Message, Prompt
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_ROWS = 1000
+BACKGROUND_DELETE_ROWS = 20000  # above this, delete_all runs as a background job
+
+
+def _delete_batches(queryset, job=None, defer=(), **progress):
+    """delete the rows of queryset, DELETE_BATCH_ROWS per transaction, return their count
+
+    defer names the fields not to load for the delete signals.
+    """
+    model = queryset.model
+    pks = queryset.order_by().values_list('pk', flat=True)
+    deleted = 0
+    while batch := list(pks[:DELETE_BATCH_ROWS]):
+        with transaction.atomic():
+            _, counts = model.objects.filter(pk__in=batch).defer(*defer).delete()
+        deleted += counts.get(model._meta.label, 0)
+        if job is not None:
+            job.update(**progress, deleted=deleted)
+    return deleted
+
+
+def _delete_messages(queryset, job=None):
+    return _delete_batches(queryset, job, defer=('message', 'messages'), stage='messages')
+
+
+def is_large(queryset):
+    return queryset.order_by().values('pk')[BACKGROUND_DELETE_ROWS:BACKGROUND_DELETE_ROWS + 1].exists()
+
+
+def delete_conversations(user, job=None):
+    """delete the composite vector stores, the messages, then the conversations of a user
+
+    The embedding documents the arxiv tool created for those conversations are
+    deleted with them. Uploaded documents are kept, they belong to the user's
+    document list.
+    """
+    tool_doc_ids = list(
+        Message.objects.filter(conversation__user=user, message_type=Message.arxiv_context_message_type)
+        .exclude(embedding_message_doc=None)
+        .order_by().values_list('embedding_message_doc_id', flat=True).distinct()
+    )
+    _delete_batches(ConversationStore.objects.filter(conversation__user=user))
+    messages = _delete_messages(Message.objects.filter(conversation__user=user), job)
+    conversations = _delete_batches(Conversation.objects.filter(user=user), job, stage='conversations')
+    documents = _delete_batches(
+        EmbeddingDocument.objects.filter(id__in=tool_doc_ids, message__isnull=True), job, defer=('faiss_store',), stage='documents',
+    )
+    logger.debug('deleted %d conversations, %d messages, %d documents of %s', conversations, messages, documents, user.pk)
+    return {'conversations': conversations, 'messages': messages, 'documents': documents}
+
+
+def delete_documents(user, job=None):
+    """delete the embedding documents of a user, with the messages and composite stores using them"""
+    _delete_batches(ConversationStore.objects.filter(conversation__message__embedding_message_doc__user=user).distinct())
+    messages = _delete_messages(Message.objects.filter(embedding_message_doc__user=user), job)
+    documents = _delete_batches(EmbeddingDocument.objects.filter(user=user), job, defer=('faiss_store',), stage='documents')
+    return {'documents': documents, 'messages': messages}
+
+
+def delete_prompts(user, job=None):
+    return {'prompts': _delete_batches(Prompt.objects.filter(user=user), job, stage='prompts')}
+
+
+def delete_job(job, delete, user):
+    return delete(user, job)
@@ -0,0 +1,66 @@
+"""
+Background jobs of the chat app, with their progress kept in the database
+
+A job runs in a small thread pool of the process that accepted it. Its state
+is written to a BackgroundJob row after every update, so any process can
+answer the progress requests of the client.
+"""
+import uuid
+import datetime
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.utils import timezone
+
+from .models import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+JOB_SECONDS = 24 * 3600  # how long the state of a job is kept
+
+job_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='job')
+
+
+class Job:
+    """state of a background job, readable with get_job"""
+
+    def __init__(self, kind, user):
+        self.id = uuid.uuid4().hex
+        self.user_id = user.pk
+        self.state = {'id': self.id, 'kind': kind, 'status': 'pending'}
+
+    def update(self, **state):
+        self.state.update(state)
+        BackgroundJob.objects.filter(id=self.id).update(state=self.state, updated_at=timezone.now())
+
+
+def _run(job, func, args):
+    try:
+        job.update(status='running')
+        result = func(job, *args)
+        job.update(status='done', **(result or {}))
+    except Exception as e:
+        logger.error('%s job %s failed %s', job.state['kind'], job.id, e)
+        job.update(status='failed', error=str(e))
+    finally:
+        connections.close_all()  # this thread is not managed by Django
+
+
+def start_job(kind, user, func, *args):
+    """run func(job, *args) in the background and return the job
+
+    func reports its progress with job.update and may return extra state.
+    Jobs older than JOB_SECONDS are forgotten meanwhile.
+    """
+    job = Job(kind, user)
+    BackgroundJob.objects.filter(updated_at__lt=timezone.now() - datetime.timedelta(seconds=JOB_SECONDS)).delete()
+    BackgroundJob.objects.create(id=job.id, user=user, kind=kind, state=job.state)
+    job_executor.submit(contextvars.copy_context().run, _run, job, func, args)
+    return job
+
+
+def get_job(job_id, user):
+    """the state of a job of the user, or None"""
+    return BackgroundJob.objects.filter(id=job_id, user=user).values_list('state', flat=True).first()
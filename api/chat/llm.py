@@ -3,7 +3,8 @@ import sys
 import logging
 import asyncio
 import threading
-import queue
+import contextvars
+import time
 import pickle
 from typing import Any, Dict, Optional, Union, Mapping
 import uuid
@@ -11,6 +12,7 @@ from uuid import UUID
 import faiss
 import hashlib
 
+import aiohttp
 import openai
 from langchain.document_loaders import (
     TextLoader,
@@ -53,16 +55,6 @@ from langchain.callbacks.manager import (
 logger = logging.getLogger(__name__)
 
 text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(chunk_size=1280, chunk_overlap=200)
-embedding_model = {
-    'name': 'openai',
-    'func': None,
-}
-
-openai_env = {
-    'api_key': None,
-    'api_base': None,
-}
-
 openai_model = {
     'name': 'gpt-3.5-turbo',
     'max_tokens': 4096,
@@ -70,37 +62,149 @@ openai_model = {
     'max_response_tokens': 1000
 }
 
-_queue = queue.Queue()
+OPENAI_DEFAULT_API_BASE = 'https://api.openai.com/v1'
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', 100))
+OPENAI_KEEPALIVE_SECONDS = int(os.getenv('OPENAI_KEEPALIVE_SECONDS', 30))
+OPENAI_CLIENT_IDLE_SECONDS = int(os.getenv('OPENAI_CLIENT_IDLE_SECONDS', 600))
 
-def setup_openai_env(api_base=None, api_key=None):
-    if not openai_env['api_base']:
-        openai_env['api_base'] = api_base
-    if not openai_env['api_key']:
-        openai_env['api_key'] = api_key
-    openai.api_base = openai_env['api_base']
-    openai.api_key = openai_env['api_key']
-    openai.api_version = None
-    return (openai_env['api_base'], openai_env['api_key'])
 
+class OpenAIResource:
+    """an openai API resource called with the credentials of one client"""
 
-def setup_openai_model(model):
-    logger.debug(model)
-    openai_model.update(model)
+    def __init__(self, resource, client):
+        self.resource = resource
+        self.client = client
+
+    def create(self, **kwargs):
+        self.client.last_used = time.monotonic()
+        return self.resource.create(**self.client.credentials, **kwargs)
+
+    async def acreate(self, **kwargs):
+        self.client.last_used = time.monotonic()
+        token = openai.aiosession.set(self.client.aiosession())
+        try:
+            return await self.resource.acreate(**self.client.credentials, **kwargs)
+        finally:
+            openai.aiosession.reset(token)
+
+
+class OpenAIClient:
+    """a long-lived OpenAI endpoint: credentials, a keep-alive connection pool and models
+
+    Credentials are passed on every call instead of being set on the global
+    openai module, so concurrent requests with different keys do not race.
+    """
+
+    def __init__(self, api_key, api_base=None):
+        self.api_key = api_key
+        self.api_base = api_base or OPENAI_DEFAULT_API_BASE
+        self.credentials = {
+            'api_key': self.api_key,
+            'api_base': self.api_base,
+            'api_type': 'open_ai',
+            'api_version': None,
+        }
+        self.last_used = time.monotonic()
+        self.ChatCompletion = OpenAIResource(openai.ChatCompletion, self)
+        self.Embedding = OpenAIResource(openai.Embedding, self)
+        self._aiosession = None
+        self._aioloop = None
+        self._embeddings = None
+        self._chat_models = {}
+
+    def aiosession(self):
+        """the aiohttp session of this client on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._aiosession is None or self._aiosession.closed or self._aioloop is not loop:
+            self.close()
+            connector = aiohttp.TCPConnector(limit=OPENAI_POOL_SIZE, keepalive_timeout=OPENAI_KEEPALIVE_SECONDS)
+            self._aiosession = aiohttp.ClientSession(connector=connector)
+            self._aioloop = loop
+        return self._aiosession
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            embeddings = OpenAIEmbeddings(openai_api_key=self.api_key)
+            embeddings.client = self.Embedding
+            self._embeddings = embeddings
+        return self._embeddings
+
+    def chat_model(self, model_name, max_tokens):
+        key = (model_name, max_tokens)
+        if key not in self._chat_models:
+            self._chat_models[key] = ChatOpenAI(
+                openai_api_key=self.api_key,
+                model_name=model_name,
+                max_tokens=max_tokens,
+                streaming=True,
+                model_kwargs={'api_key': self.api_key, 'api_base': self.api_base},
+            )
+        return self._chat_models[key]
+
+    def close(self):
+        if self._aiosession is not None and not self._aiosession.closed and not self._aioloop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._aiosession.close(), self._aioloop)
+        self._aiosession = None
+
+
+_openai_clients = {}
+_openai_clients_lock = threading.Lock()
+_current_openai_client = contextvars.ContextVar('current_openai_client', default=None)
+_current_openai_model = contextvars.ContextVar('current_openai_model', default=openai_model)
+
+
+def get_openai_client(api_key, api_base=None):
+    """return the shared client of (api_base, api_key), evicting clients left idle"""
+    api_base = api_base or OPENAI_DEFAULT_API_BASE
+    key = (api_base, hashlib.sha256(api_key.encode()).hexdigest())
+    now = time.monotonic()
+    with _openai_clients_lock:
+        for idle_key in [k for k, c in _openai_clients.items() if now - c.last_used > OPENAI_CLIENT_IDLE_SECONDS]:
+            _openai_clients.pop(idle_key).close()
+        client = _openai_clients.get(key)
+        if client is None:
+            client = _openai_clients[key] = OpenAIClient(api_key, api_base)
+        client.last_used = now
+    return client
+
+
+def use_openai_client(client):
+    """make client the OpenAI client of the current request context
+
+    Threads started without a copy of that context must be given the client
+    explicitly, there is no process-wide fallback.
+    """
+    _current_openai_client.set(client)
+    return client
+
+
+def get_current_openai_client():
+    client = _current_openai_client.get()
+    if client is None:
+        raise RuntimeError('There is no OpenAI client in the current context')
+    return client
+
+
+def use_openai_model(model):
+    """make model the chat model settings of the current request context"""
     logger.debug(model)
+    _current_openai_model.set(model)
 
 
-# class OutputStreamingCallbackHandler(AsyncCallbackHandler):
-class OutputStreamingCallbackHandler(BaseCallbackHandler):
-    send_token: bool = False
+class OutputStreamingCallbackHandler(AsyncCallbackHandler):
+    """stream the tokens of one request into its own asyncio queue"""
+
+    def __init__(self, channel=None):
+        self.queue = channel if channel is not None else asyncio.Queue()
+        self.send_token = False
 
     # make it a producer to send us reply
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         if self.send_token:
-            _queue.put(token)
-            # sys.stdout.write(token)
-            # sys.stdout.flush()
+            self.queue.put_nowait(token)
 
-    def on_chain_start(self, serialized, inputs, **kwargs) -> Any:
+    async def on_chain_start(self, serialized, inputs, **kwargs) -> Any:
         """run when chain start running"""
         # don't stream the output from intermedia steps
         logger.debug('****** launch chain %s', serialized)
@@ -108,80 +212,64 @@ class OutputStreamingCallbackHandler(BaseCallbackHandler):
             logger.debug('start output streamming')
             self.send_token = True
 
-    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any,) -> None:
-        """Run when chain ends running."""
-        # _queue.put(-1)
-        # return await super().on_chain_end(outputs, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
-
-    def on_llm_error( self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
+    async def on_llm_error( self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
         """Run when LLM errors."""
-        _queue.put(-1)
+        self.queue.put_nowait(-1)
 
-    def on_chain_error( self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
+    async def on_chain_error( self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
         """Run when chain errors."""
-        _queue.put(-1)
-
-
-OSC = OutputStreamingCallbackHandler()
+        self.queue.put_nowait(-1)
 
 
 class EmbeddingModel:
     def __init__(self):
-        self.name = None
-        self._function = None
+        self.name = 'openai'
 
     @property
     def function(self):
-        """embedding function of the model"""
-        if not self._function:
-            setup_openai_env()
-            self.name = 'openai'
-            self._function = OpenAIEmbeddings()
-        return self._function
+        """embedding function of the current OpenAI client"""
+        return get_current_openai_client().embeddings
 
 
 class ChatModel:
     def __init__(self):
-        self.name = None
-        self._model = None
+        self.name = 'open_ai'
 
     @property
     def model(self):
-        if not self._model:
-            api_base, api_key = setup_openai_env()
-            self.name = 'open_ai'
-            max_response_tokens = openai_model['max_prompt_tokens']
-            if max_response_tokens > 1024:
-                max_response_tokens = 1024
-            self._model = ChatOpenAI(
-                api_key=api_key,
-                api_base=api_base,
-                model_name=openai_model['name'],
-                max_tokens=max_response_tokens,
-                streaming=True,
-                # callbacks=[OSC],
-            )
-        return self._model
+        """chat model of the current OpenAI client and model settings"""
+        model = _current_openai_model.get()
+        max_response_tokens = model['max_prompt_tokens']
+        if max_response_tokens > 1024:
+            max_response_tokens = 1024
+        return get_current_openai_client().chat_model(model['name'], max_response_tokens)
 
 
 embedding_model = EmbeddingModel()
 chat_model = ChatModel()
 
+
+def embed_query(text):
+    """embed a query with the current OpenAI client, so shared stores do not pin a key"""
+    return embedding_model.function.embed_query(text)
+
+
 def pickle_faiss(db):
     idx = faiss.serialize_index(db.index)
     pickled = pickle.dumps((db.docstore, db.index_to_docstore_id, idx))
     return pickled
 
 def unpick_faiss(pickled, embedding_func = None):
-    if not embedding_func:
-        embedding_func = embedding_model.function
     docstore, index_to_docstore_id, idx = pickle.loads(pickled)
     index = faiss.deserialize_index(idx)
-    db = FAISS(embedding_func.embed_query, index, docstore, index_to_docstore_id)
+    db = FAISS(embedding_func.embed_query if embedding_func else embed_query, index, docstore, index_to_docstore_id)
     return db
 
-def get_embedding_document(file, mime):
-    """return a pickled faiss vectorsotre"""
+def get_embedding_document(file, mime, embeddings_function=None):
+    """return a faiss vectorsotre of the file, embedded with embeddings_function
+
+    It defaults to the embeddings of the current OpenAI client.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Common_types
     loaders = {
@@ -194,7 +282,8 @@ def get_embedding_document(file, mime):
     loader = loaders[mime](file)
     docs = loader.load()
 
-    embeddings_function = embedding_model.function
+    if embeddings_function is None:
+        embeddings_function = embedding_model.function
 
     for doc in docs:
         hash_str = str(hashlib.md5(str(doc).encode()).hexdigest())
@@ -202,7 +291,7 @@ def get_embedding_document(file, mime):
     documents = text_splitter.split_documents(docs)
     db = FAISS.from_documents(documents, embeddings_function)
 
-    return pickle_faiss(db)
+    return db
 
 
 condense_question_template = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question.
@@ -214,10 +303,13 @@ Standalone question (in the same language of Follow Up Input):"""
 MY_CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(condense_question_template)
 
 
-def langchain_doc_chat(messages):
-    """use langchain to process a list of messages"""
+async def langchain_doc_chat(messages):
+    """use langchain to process a list of messages, yielding the answer tokens"""
 
+    # the retriever may embed the question in an executor thread, without the
+    # request context: bind the store to the embeddings of this request
     db = messages['faiss_store']
+    db = FAISS(embedding_model.function.embed_query, db.index, db.docstore, db.index_to_docstore_id)
     retriever = db.as_retriever(
         search_type="mmr",
         #search_type="similarity",
@@ -248,45 +340,45 @@ def langchain_doc_chat(messages):
         combine_docs_chain=doc_chain,
     )
 
-    results = []
     msgs = messages['messages']
     q = msgs[-1]['content']
     logger.debug(q)
-    OSC.send_token = False
+    handler = OutputStreamingCallbackHandler()
+    channel = handler.queue
 
     async def do_chain():
-        result = await chain.acall(
-            {'question': q},
-            callbacks=[OSC],
-        )
-        _queue.put(-1)
-        return result
-
-    def ctx_mgr():
-        result = asyncio.run(do_chain())
-        results.append(result)
-
-    thread = threading.Thread(target=ctx_mgr)
-    thread.start()
-
-    while True:
-        item = _queue.get()
-        # logger.debug('>>>>\n>>>> partial item %s', item)
-        if item == -1:
-            logger.debug('langchan done')
+        try:
+            return await chain.acall(
+                {'question': q},
+                callbacks=[handler],
+            )
+        finally:
+            channel.put_nowait(-1)
+
+    task = asyncio.create_task(do_chain())
+
+    try:
+        while True:
+            item = await channel.get()
+            # logger.debug('>>>>\n>>>> partial item %s', item)
+            if item == -1:
+                logger.debug('langchan done')
+                yield {
+                    'content': item,
+                    'status': 'done',
+                }
+                break
             yield {
                 'content': item,
-                'status': 'done',
+                'status': None,
             }
-            _queue.task_done()
-            break
-        yield {
-            'content': item,
-            'status': None,
-        }
-        _queue.task_done()
-
-    thread.join()
-    logger.debug('langchan exit with %s', results[0])  # should output a coroutine
-
-    return
+    finally:
+        if not task.done():  # the reader went away, stop the chain
+            task.cancel()
+
+    try:
+        result = await task
+        logger.debug('langchan exit with %s', result)
+    except Exception as e:
+        logger.error('langchain error %s', e)
+        raise  # the answer streamed so far is not complete
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    def backfill_message_tokens(apps, schema_editor):
+        """store the content token count of every message
+
+        User messages used to store the token count of the whole prompt.
+        """
+        import tiktoken
+
+        Message = apps.get_model('chat', 'message')
+        encoding = tiktoken.get_encoding('cl100k_base')
+        batch = []
+        for message in Message.objects.only('id', 'message').iterator(chunk_size=2000):
+            message.tokens = len(encoding.encode(message.message))
+            batch.append(message)
+            if len(batch) >= 2000:
+                Message.objects.bulk_update(batch, ['tokens'])
+                batch = []
+        if batch:
+            Message.objects.bulk_update(batch, ['tokens'])
+
+    dependencies = [
+        ('chat', '0008_message_message_type_message_user_embeddingdocument_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at'], name='chat_msg_conv_created_idx'),
+        ),
+        migrations.RunPython(backfill_message_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # the store layout as of this migration, frozen so later changes to
+    # chat.vectorstore do not change what this migration writes
+    INDEX_FILE = 'index.faiss'
+    DOCSTORE_FILE = 'docstore.json'
+
+    def write_store(store_path, index, docstore, index_to_docstore_id):
+        """write an index and its columnar docstore into store_path, atomically"""
+        import os
+        import json
+        import faiss
+        from django.conf import settings
+
+        target = os.path.join(settings.EMBEDDING_STORE_DIR, store_path)
+        tmp = target + '.tmp'
+        os.makedirs(tmp)
+        faiss.write_index(index, os.path.join(tmp, Migration.INDEX_FILE))
+        ids = [index_to_docstore_id[i] for i in range(len(index_to_docstore_id))]
+        docs = [docstore.search(i) for i in ids]
+        columns = {
+            'ids': ids,
+            'page_content': [doc.page_content for doc in docs],
+            'metadata': [doc.metadata for doc in docs],
+        }
+        with open(os.path.join(tmp, Migration.DOCSTORE_FILE), 'w') as f:
+            json.dump(columns, f, default=str)
+        os.replace(tmp, target)
+
+    def move_faiss_store_to_disk(apps, schema_editor):
+        """write the pickled faiss_store blobs into store files"""
+        import os
+        import uuid
+        import pickle
+        import faiss
+
+        EmbeddingDocument = apps.get_model('chat', 'embeddingdocument')
+        legacy = EmbeddingDocument.objects.filter(faiss_store__isnull=False, store_path='')
+        for doc in legacy.only('id', 'user_id', 'faiss_store').iterator(chunk_size=10):
+            docstore, index_to_docstore_id, idx = pickle.loads(bytes(doc.faiss_store))
+            store_path = os.path.join(str(doc.user_id), uuid.uuid4().hex)
+            Migration.write_store(store_path, faiss.deserialize_index(idx), docstore, index_to_docstore_id)
+            EmbeddingDocument.objects.filter(id=doc.id).update(store_path=store_path, faiss_store=None)
+
+    dependencies = [
+        ('chat', '0010_embeddingdocument_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='embeddingdocument',
+            name='store_path',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RunPython(move_faiss_store_to_disk, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_embeddingdocument_store_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationStore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('store_path', models.CharField(blank=True, default='', max_length=255)),
+                ('doc_ids', models.TextField(default='')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='chat.conversation')),
+            ],
+        ),
+    ]
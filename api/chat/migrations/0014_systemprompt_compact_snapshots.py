@@ -0,0 +1,114 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # the snapshot format as of this migration, frozen so later changes to
+    # chat.snapshots do not change what this migration writes
+    SNAPSHOT_VERSION = 2
+
+    def system_prompt_digest(content):
+        import hashlib
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def dump_snapshot(system_content, message_ids, tail):
+        import json
+        return json.dumps({
+            'v': Migration.SNAPSHOT_VERSION,
+            'system': Migration.system_prompt_digest(system_content) if system_content is not None else None,
+            'ids': message_ids,
+            'tail': tail,
+        })
+
+    def parse_legacy_snapshot(value):
+        """the prompt list of a snapshot stored as a full copy, or None"""
+        import ast
+        import json
+        for parse in (json.loads, ast.literal_eval):
+            try:
+                prompt = parse(value)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                continue
+            if isinstance(prompt, list):
+                return prompt
+        return None
+
+    def compact_snapshots(apps, schema_editor):
+        """replace the full prompt copies of Message.messages by references
+
+        A prompt message is referenced by the id of the latest earlier row of the
+        conversation with the same role and content. Messages that cannot be
+        matched are kept inline, in order.
+        """
+        SNAPSHOT_VERSION = Migration.SNAPSHOT_VERSION
+        dump_snapshot = Migration.dump_snapshot
+        parse_legacy_snapshot = Migration.parse_legacy_snapshot
+        system_prompt_digest = Migration.system_prompt_digest
+
+        Conversation = apps.get_model('chat', 'conversation')
+        Message = apps.get_model('chat', 'message')
+        SystemPrompt = apps.get_model('chat', 'systemprompt')
+
+        system_prompts = {}
+        batch = []
+        for conversation_id in list(Conversation.objects.values_list('id', flat=True)):
+            rows = (
+                Message.objects.filter(conversation_id=conversation_id)
+                .order_by('created_at', 'id')
+                .values_list('id', 'is_bot', 'message', 'messages')
+            )
+            seen = {}
+            for message_id, is_bot, content, snapshot in rows:
+                seen[(is_bot, content)] = message_id
+                if not snapshot or snapshot.startswith('{"v": %d' % SNAPSHOT_VERSION):
+                    continue
+                prompt = parse_legacy_snapshot(snapshot)
+                if prompt is None:
+                    compacted = ''
+                else:
+                    system_content = None
+                    message_ids = []
+                    tail = []
+                    for entry in prompt:
+                        if not isinstance(entry, dict):
+                            continue
+                        role, entry_content = entry.get('role'), entry.get('content')
+                        if role == 'system' and system_content is None and not message_ids and not tail:
+                            system_content = entry_content
+                            continue
+                        reference = seen.get((role == 'assistant', entry_content))
+                        if reference is not None and not tail:
+                            message_ids.append(reference)
+                        else:
+                            tail.append({'role': role, 'content': entry_content})
+                    if system_content is not None:
+                        system_prompts.setdefault(system_prompt_digest(system_content), system_content)
+                    compacted = dump_snapshot(system_content, message_ids, tail)
+                batch.append(Message(id=message_id, messages=compacted))
+                if len(batch) >= 1000:
+                    Message.objects.bulk_update(batch, ['messages'])
+                    batch = []
+        if batch:
+            Message.objects.bulk_update(batch, ['messages'])
+
+        existing = set(SystemPrompt.objects.filter(digest__in=list(system_prompts)).values_list('digest', flat=True))
+        SystemPrompt.objects.bulk_create([
+            SystemPrompt(digest=digest, content=content)
+            for digest, content in system_prompts.items() if digest not in existing
+        ])
+
+    dependencies = [
+        ('chat', '0013_conversation_message_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SystemPrompt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('content', models.TextField()),
+            ],
+        ),
+        migrations.RunPython(compact_snapshots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_systemprompt_compact_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='is_truncated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -7,28 +7,67 @@ logger = logging.getLogger(__name__)
 
 class EmbeddingDocument(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    faiss_store = models.BinaryField(null=True)
+    faiss_store = models.BinaryField(null=True)  # legacy pickled store, see store_path
+    store_path = models.CharField(max_length=255, blank=True, default='')
     title = models.CharField(max_length=255, default="")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
 
 class Conversation(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     topic = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='chat_conv_user_created_idx'),
+        ]
+
+
+class ConversationStore(models.Model):
+    """composite vector store of the documents attached to a conversation"""
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE)
+    store_path = models.CharField(max_length=255, blank=True, default='')
+    doc_ids = models.TextField(default='')  # comma separated, in merge order
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BackgroundJob(models.Model):
+    """state of a background job, see chat/jobs.py"""
+    id = models.CharField(max_length=32, primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=32)
+    state = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class SystemPrompt(models.Model):
+    """system prompts referenced by the prompt snapshots of messages"""
+    digest = models.CharField(max_length=64, unique=True)
+    content = models.TextField()
 
 
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     message = models.TextField()
-    messages = models.TextField(default='')
+    messages = models.TextField(default='')  # prompt snapshot by reference, see chat/snapshots.py
     tokens = models.IntegerField(default=0)
     is_bot = models.BooleanField(default=False)
     is_disabled = models.BooleanField(default=False)
+    is_truncated = models.BooleanField(default=False)  # the client disconnected before the answer was complete
     message_type = models.IntegerField(default=0)
     embedding_message_doc = models.ForeignKey(EmbeddingDocument, on_delete=models.CASCADE, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'created_at'], name='chat_msg_conv_created_idx'),
+        ]
 
     plain_message_type = 0
     hidden_message_type = 1
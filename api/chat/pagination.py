@@ -0,0 +1,120 @@
+"""
+Keyset pagination and conditional GET for the chat listings
+"""
+import base64
+import hashlib
+import datetime
+
+from django.db.models import Count, Max, Q
+from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """cursor pagination on (created_at, id)
+
+    The direction follows the ordering of the queryset on created_at. A cursor
+    is the position of the last row of the previous page, so a page costs one
+    index range scan whatever its depth.
+    """
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            created_at, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split('|')
+            return datetime.datetime.fromisoformat(created_at), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def encode_cursor(obj):
+        return base64.urlsafe_b64encode(f'{obj.created_at.isoformat()}|{obj.pk}'.encode()).decode()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        descending = bool(queryset.query.order_by) and queryset.query.order_by[0] == '-created_at'
+        if descending:
+            queryset = queryset.order_by('-created_at', '-id')
+        else:
+            queryset = queryset.order_by('created_at', 'id')
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            created_at, pk = position
+            if descending:
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+            else:
+                queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+
+        rows = list(queryset[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        self.page = rows[:page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        # relative, so it is valid behind the proxy and during server rendering
+        return replace_query_param(self.request.get_full_path(), self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+
+class ConditionalListMixin:
+    """answer list requests with a weak ETag and 304 when nothing changed
+
+    The ETag is derived from the row count and the latest updated_at of the
+    whole listing, so the check is one aggregate query and no serializer pass.
+    """
+    list_fields = None
+
+    def list_etag(self, queryset):
+        state = queryset.order_by().aggregate(count=Count('id'), latest=Max('updated_at'))
+        key = f'{self.request.user.pk}|{self.request.get_full_path()}|{state["count"]}|{state["latest"]}'
+        return 'W/"%s"' % hashlib.md5(key.encode()).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        etag = self.list_etag(queryset)
+        if_none_match = request.headers.get('If-None-Match', '')
+        if etag in (tag.strip() for tag in if_none_match.split(',')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            if self.list_fields:
+                queryset = queryset.only(*self.list_fields)
+            page = self.paginate_queryset(queryset)
+            response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
@@ -1,8 +1,11 @@
 import os
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, post_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
 from django.db.utils import OperationalError
-from .models import Setting
+from .models import Setting, EmbeddingDocument, ConversationStore, Message
+from .vectorstore import delete_faiss, invalidate_conversation_stores
+from .config import settings_cache
 
 @receiver(post_migrate)
 def load_default_settings(sender, **kwargs):
@@ -25,3 +28,32 @@ def load_default_settings(sender, **kwargs):
             if env_key_val:
                 Setting.objects.create(name='openai_api_key', value=env_key_val)
                 print('Created setting: openai_api_key')
+
+
+@receiver(post_save, sender=Setting)
+@receiver(post_delete, sender=Setting)
+def invalidate_settings(sender, **kwargs):
+    # after the commit, a reader could cache the old values again otherwise
+    transaction.on_commit(settings_cache.invalidate)
+
+
+@receiver(post_delete, sender=EmbeddingDocument)
+def delete_embedding_store(sender, instance, **kwargs):
+    delete_faiss(instance.store_path)
+
+
+@receiver(post_save, sender=EmbeddingDocument)
+def update_embedding_store(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_conversation_stores(conversation__message__embedding_message_doc_id=instance.id)
+
+
+@receiver(post_delete, sender=ConversationStore)
+def delete_conversation_store(sender, instance, **kwargs):
+    delete_faiss(instance.store_path)
+
+
+@receiver(post_delete, sender=Message)
+def delete_context_message(sender, instance, **kwargs):
+    if instance.embedding_message_doc_id:
+        invalidate_conversation_stores(conversation_id=instance.conversation_id)
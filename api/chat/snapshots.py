@@ -0,0 +1,100 @@
+"""
+Prompt snapshots of user messages
+
+Message.messages used to hold a copy of the whole prompt sent with the
+message, so storage grew quadratically with the conversation. A snapshot is
+now a reference: the digest of the system prompt, the ordered ids of the
+stored messages that were sent, and the prompt messages that have no row of
+their own (the new messages of the turn, or a message rewritten by a tool).
+The prompt is only rebuilt on demand, by load_snapshot.
+"""
+import ast
+import json
+import hashlib
+import logging
+
+from django.db import transaction
+
+from .models import Message, SystemPrompt
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+
+_stored_digests = set()
+
+
+def system_prompt_digest(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def dump_snapshot(system_content, message_ids, tail):
+    return json.dumps({
+        'v': SNAPSHOT_VERSION,
+        'system': system_prompt_digest(system_content) if system_content is not None else None,
+        'ids': message_ids,
+        'tail': tail,
+    })
+
+
+def prompt_snapshot(prompt, prompt_ids):
+    """the snapshot of a prompt whose messages map to prompt_ids, None where there is no row
+
+    prompt starts with the system message. Rows are referenced up to the first
+    message without one, the rest is kept inline so the order is preserved.
+    """
+    system_content = prompt[0]['content'] if prompt and prompt[0]['role'] == 'system' else None
+    messages = prompt[1:] if system_content is not None else prompt
+    message_ids = []
+    for idx, message_id in enumerate(prompt_ids):
+        if message_id is None:
+            return dump_snapshot(system_content, message_ids, messages[idx:])
+        message_ids.append(message_id)
+    return dump_snapshot(system_content, message_ids, [])
+
+
+def parse_legacy_snapshot(value):
+    """the prompt list of a snapshot stored as a full copy, or None"""
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            prompt = parse(value)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        if isinstance(prompt, list):
+            return prompt
+    return None
+
+
+def store_system_prompt(content):
+    """make sure the system prompt referenced by a snapshot is stored"""
+    digest = system_prompt_digest(content)
+    if digest in _stored_digests:
+        return
+    SystemPrompt.objects.get_or_create(digest=digest, defaults={'content': content})
+    transaction.on_commit(lambda: _stored_digests.add(digest))
+
+
+def load_snapshot(message):
+    """rebuild the prompt sent with a message, as a list of role/content dicts"""
+    if not message.messages:
+        return []
+    try:
+        snapshot = json.loads(message.messages)
+    except ValueError:
+        snapshot = None
+    if not isinstance(snapshot, dict) or snapshot.get('v') != SNAPSHOT_VERSION:
+        return parse_legacy_snapshot(message.messages) or []
+
+    prompt = []
+    if snapshot['system']:
+        content = SystemPrompt.objects.filter(digest=snapshot['system']).values_list('content', flat=True).first()
+        if content is None:
+            logger.warning('system prompt %s of message %s is missing', snapshot['system'], message.id)
+        else:
+            prompt.append({'role': 'system', 'content': content})
+    rows = Message.objects.only('id', 'is_bot', 'message').in_bulk(snapshot['ids'])
+    for message_id in snapshot['ids']:
+        row = rows.get(message_id)
+        if row is not None:  # deleted messages are skipped
+            prompt.append({'role': 'assistant' if row.is_bot else 'user', 'content': row.message})
+    return prompt + snapshot['tail']
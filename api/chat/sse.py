@@ -0,0 +1,325 @@
+"""
+Server-sent events of the conversation stream
+
+When answers are resumable (settings.SSE_RESUME), a generation runs apart
+from the request that started it and writes its frames to a short-lived
+buffer: a Redis stream when REDIS_URL is set, a ring buffer in process memory
+with a single worker. The response reads the frames back with ids, so a
+client reconnecting with Last-Event-ID gets the frames it missed and then the
+live tail.
+"""
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_SECONDS = 1
+_END = object()
+_FLUSH = object()
+
+
+def sse_pack(event, data):
+    # Format data as an SSE message
+    packet = "event: %s\n" % event
+    packet += "data: %s\n" % json.dumps(data)
+    packet += "\n"
+    return packet
+
+
+def _feed(items, channel, disconnected=None):
+    """pull items into channel, then _END, or _END as soon as disconnected is set
+
+    Returns the pulling and the watching tasks, see _stop_feed.
+    """
+    async def pull():
+        try:
+            async for item in items:
+                channel.put_nowait((item, None))
+        except Exception as e:
+            channel.put_nowait((_END, e))
+        else:
+            channel.put_nowait((_END, None))
+
+    async def watch():
+        await disconnected.wait()
+        channel.put_nowait((_END, None))
+
+    puller = asyncio.ensure_future(pull())
+    watcher = asyncio.ensure_future(watch()) if disconnected is not None else None
+    return puller, watcher
+
+
+async def _stop_feed(puller, watcher):
+    """cancel the tasks of _feed, which closes the upstream generator"""
+    if watcher is not None:
+        watcher.cancel()
+    puller.cancel()
+    await asyncio.wait({puller})
+
+
+async def coalesce(deltas, interval_ms=None, max_bytes=None, disconnected=None):
+    """merge the text deltas of a stream into fewer chunks
+
+    The first delta is yielded at once, so the time to first token does not
+    change. The next ones are buffered and flushed interval_ms after the first
+    of them arrived, or as soon as max_bytes are buffered, or at the end. The
+    stream stops early when the disconnected event is set.
+
+    Deltas, flush deadlines and the disconnect all arrive through one queue, so
+    no task is created per delta.
+    """
+    interval = (settings.SSE_COALESCE_MS if interval_ms is None else interval_ms) / 1000
+    max_bytes = settings.SSE_COALESCE_BYTES if max_bytes is None else max_bytes
+    loop = asyncio.get_running_loop()
+    channel = asyncio.Queue()
+    puller, watcher = _feed(deltas, channel, disconnected)
+    buffer = []
+    size = 0
+    flushes = 0  # tells the deadline of the current buffer from stale ones
+    timer = None
+    first = True
+    try:
+        while True:
+            item, detail = await channel.get()
+            if item is _FLUSH:
+                if detail == flushes and buffer:
+                    flushes += 1
+                    yield ''.join(buffer)
+                    buffer, size = [], 0
+                continue
+            if item is _END:
+                if detail is not None:
+                    raise detail
+                break
+
+            if first or interval <= 0:
+                first = False
+                yield item
+                continue
+            if not buffer:
+                timer = loop.call_later(interval, channel.put_nowait, (_FLUSH, flushes))
+            buffer.append(item)
+            size += len(item)
+            if size >= max_bytes:
+                timer.cancel()
+                flushes += 1
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        await _stop_feed(puller, watcher)
+
+
+def client_disconnected(request):
+    """the event set when the client of a streaming request disconnects
+
+    It is provided by chatgpt_ui_server.asgi, other servers get one that is never set.
+    """
+    return getattr(request, 'scope', {}).get('disconnected') or asyncio.Event()
+
+
+async def until_disconnected(items, disconnected):
+    """iterate items until the disconnected event is set
+
+    The pending item is then cancelled, which closes the upstream generator.
+    """
+    channel = asyncio.Queue()
+    puller, watcher = _feed(items, channel, disconnected)
+    try:
+        while True:
+            item, error = await channel.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        await _stop_feed(puller, watcher)
+
+
+class ResumeError(Exception):
+    """the frames asked for are expired or were never buffered"""
+
+
+class _MemoryStream:
+    def __init__(self, max_frames, expires_at):
+        self.frames = deque(maxlen=max_frames)
+        self.expires_at = expires_at
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class MemoryStreamBuffer:
+    """ring buffers of frames in process memory, for single-node deployments"""
+
+    def __init__(self, max_frames, ttl):
+        self.max_frames = max_frames
+        self.ttl = ttl
+        self._streams = {}
+        self._readers = {}
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, stream in self._streams.items() if stream.expires_at < now]:
+            del self._streams[key]
+        for key in [key for key, until in self._readers.items() if until < now]:
+            del self._readers[key]
+
+    def _get(self, key):
+        self._expire()
+        stream = self._streams.get(key)
+        if stream is None:
+            raise ResumeError(key)
+        return stream
+
+    async def append(self, key, seq, frame):
+        if seq == 1:
+            self._expire()
+            self._streams[key] = _MemoryStream(self.max_frames, time.monotonic() + self.ttl)
+        stream = self._get(key)
+        stream.frames.append((seq, frame))
+        stream.expires_at = time.monotonic() + self.ttl
+        stream.notify()
+
+    async def check(self, key, after):
+        frames = self._get(key).frames
+        if not frames or frames[0][0] > after + 1:
+            raise ResumeError(key)
+
+    async def read(self, key, after):
+        """the (seq, frame) entries after seq, waiting for new ones up to HEARTBEAT_SECONDS"""
+        stream = self._get(key)
+        entries = [entry for entry in stream.frames if entry[0] > after]
+        if not entries:
+            try:
+                await asyncio.wait_for(stream.changed.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                return []
+            entries = [entry for entry in stream.frames if entry[0] > after]
+        return entries
+
+    async def touch(self, key, seconds):
+        self._readers[key] = time.monotonic() + seconds
+
+    async def has_reader(self, key):
+        return self._readers.get(key, 0.0) > time.monotonic()
+
+
+class RedisStreamBuffer:
+    """frames in Redis streams shared by the processes, with entry ids 0-<seq>"""
+
+    def __init__(self, url, max_frames, ttl):
+        from redis import asyncio as aioredis
+
+        self.max_frames = max_frames
+        self.ttl = ttl
+        self._redis = aioredis.from_url(url, decode_responses=True)
+
+    async def append(self, key, seq, frame):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            fields = {'end': ''} if frame is None else {'frame': frame}
+            pipe.xadd(key, fields, id=f'0-{seq}', maxlen=self.max_frames, approximate=True)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def check(self, key, after):
+        first = await self._redis.xrange(key, count=1)
+        if not first or int(first[0][0].split('-')[1]) > after + 1:
+            raise ResumeError(key)
+
+    async def read(self, key, after):
+        """the (seq, frame) entries after seq, waiting for new ones up to HEARTBEAT_SECONDS"""
+        if not await self._redis.exists(key):
+            raise ResumeError(key)
+        result = await self._redis.xread({key: f'0-{after}'}, count=256, block=HEARTBEAT_SECONDS * 1000)
+        return [
+            (int(entry_id.split('-')[1]), fields.get('frame'))
+            for _, entries in result for entry_id, fields in entries
+        ]
+
+    async def touch(self, key, seconds):
+        await self._redis.set(f'{key}:reader', 1, ex=seconds)
+
+    async def has_reader(self, key):
+        return bool(await self._redis.exists(f'{key}:reader'))
+
+
+if not settings.SSE_RESUME:
+    stream_buffer = None  # a worker could not replay the frames of another
+elif settings.REDIS_URL:
+    stream_buffer = RedisStreamBuffer(settings.REDIS_URL, settings.SSE_BUFFER_FRAMES, settings.SSE_BUFFER_SECONDS)
+else:
+    stream_buffer = MemoryStreamBuffer(settings.SSE_BUFFER_FRAMES, settings.SSE_BUFFER_SECONDS)
+
+
+def stream_key(user_id, generation_id):
+    return f'sse:{user_id}:{generation_id}'
+
+
+def parse_event_id(event_id):
+    """split an event id into its generation id and seq, or raise ValueError"""
+    generation_id, seq = event_id.split(':')
+    return generation_id, int(seq)
+
+
+async def replay(key, generation_id, after=0):
+    """the frames of a generation after seq, with their ids, until it ends
+
+    A frame without content marks the start of the generation, None its end.
+    """
+    while True:
+        await stream_buffer.touch(key, settings.SSE_RESUME_SECONDS)
+        for seq, frame in await stream_buffer.read(key, after):
+            if frame is None:
+                return
+            after = seq
+            if frame:
+                yield f'id: {generation_id}:{seq}\n' + frame
+
+
+_publishers = set()
+
+
+async def publish(key, frames, abandoned):
+    """run a generation apart from its request, writing its frames to the buffer
+
+    The generation is abandoned, through the abandoned event, when no reader
+    was seen for SSE_RESUME_SECONDS. Returns once the buffer is started.
+    """
+    await stream_buffer.append(key, 1, '')
+    await stream_buffer.touch(key, settings.SSE_RESUME_SECONDS)
+
+    async def watch_readers():
+        while not abandoned.is_set():
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            if not await stream_buffer.has_reader(key):
+                logger.info('no reader left for %s, stop generating', key)
+                abandoned.set()
+
+    async def run():
+        seq = 1
+        watcher = asyncio.ensure_future(watch_readers())
+        try:
+            async for frame in frames:
+                seq += 1
+                await stream_buffer.append(key, seq, frame)
+        except Exception as e:
+            logger.error('cannot publish %s %s', key, e)
+        finally:
+            watcher.cancel()
+            await stream_buffer.append(key, seq + 1, None)
+
+    task = asyncio.ensure_future(run())
+    _publishers.add(task)  # keep a reference until it is done
+    task.add_done_callback(_publishers.discard)
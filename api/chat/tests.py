@@ -1,3 +1,632 @@
-from django.test import TestCase
+import io
+import os
+import json
+import asyncio
+import importlib
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import ijson
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from utils import duckduckgo_search
+from utils.search_abc import SearchRequest
+from . import sse, deletion, transfer
+from .jobs import Job
+from .llm import OutputStreamingCallbackHandler
+from .models import Conversation, ConversationStore, EmbeddingDocument, Message, Prompt, SystemPrompt
+from .snapshots import SNAPSHOT_VERSION, load_snapshot, parse_legacy_snapshot, prompt_snapshot, store_system_prompt
+
+
+class OutputStreamingCallbackHandlerTests(SimpleTestCase):
+
+    def test_concurrent_streams_are_isolated(self):
+        async def produce(idx, handler):
+            await handler.on_chain_start({'name': 'StuffDocumentsChain'}, {})
+            for n in range(200):
+                await handler.on_llm_new_token(f'{idx}:{n}')
+                await asyncio.sleep(0)  # let the other streams interleave
+            handler.queue.put_nowait(-1)
+
+        async def consume(handler):
+            tokens = []
+            while (item := await handler.queue.get()) != -1:
+                tokens.append(item)
+            return tokens
+
+        async def run():
+            handlers = [OutputStreamingCallbackHandler() for _ in range(8)]
+            consumers = [asyncio.create_task(consume(handler)) for handler in handlers]
+            await asyncio.gather(*(produce(idx, handler) for idx, handler in enumerate(handlers)))
+            return await asyncio.gather(*consumers)
+
+        for idx, tokens in enumerate(asyncio.run(run())):
+            self.assertEqual(tokens, [f'{idx}:{n}' for n in range(200)])
+
+    def test_intermediate_chain_tokens_are_not_streamed(self):
+        async def run():
+            handler = OutputStreamingCallbackHandler()
+            await handler.on_llm_new_token('condensed question')
+            return handler.queue.empty()
+
+        self.assertTrue(asyncio.run(run()))
+
+
+SEARCH_HTML = """<html><body>
+<table></table><table></table>
+<table>
+<tr><td><a class="result-link" href="{base}/page/1">First</a></td></tr>
+<tr><td class="result-snippet">first snippet</td></tr>
+<tr><td><a class="result-link" href="{base}/page/2">Second</a></td></tr>
+<tr><td class="result-snippet">second snippet</td></tr>
+</table>
+</body></html>"""
+
+
+class _SearchStandIn(BaseHTTPRequestHandler):
+    """answers like the lite DuckDuckGo page and serves the result pages"""
+    hits = []
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_POST(self):
+        self.hits.append(self.path)
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._reply(SEARCH_HTML.format(base=self.server.base_url))
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        self._reply(f'<html><script>x()</script><body>content of {self.path}</body></html>')
+
+    def log_message(self, *args):
+        pass
+
+
+class WebSearchTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _SearchStandIn)
+        cls.server.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        _SearchStandIn.hits.clear()
+        patcher = mock.patch.object(duckduckgo_search, 'BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_results_are_cached(self):
+        search = SearchRequest('django', timerange='m', region='us-en')
+        first = duckduckgo_search.web_search(search, 5, fetch_pages=0)
+        second = duckduckgo_search.web_search(search, 5, fetch_pages=0)
+        self.assertEqual([r.title for r in first], ['First', 'Second'])
+        self.assertEqual([r.title for r in second], ['First', 'Second'])
+        self.assertEqual(_SearchStandIn.hits, ['/lite/'])
+
+        duckduckgo_search.web_search(SearchRequest('django', timerange='y', region='us-en'), 5, fetch_pages=0)
+        self.assertEqual(_SearchStandIn.hits, ['/lite/', '/lite/'])
+
+    def test_top_pages_enrich_snippets(self):
+        results = duckduckgo_search.web_search(SearchRequest('django'), 5, fetch_pages=1)
+        self.assertEqual(results[0].body, 'first snippet\ncontent of /page/1')
+        self.assertEqual(results[1].body, 'second snippet')
+        self.assertEqual(sorted(_SearchStandIn.hits), ['/lite/', '/page/1'])
+
+
+class CoalesceTests(SimpleTestCase):
+
+    @staticmethod
+    def collect(deltas, **kwargs):
+        async def run():
+            return [chunk async for chunk in sse.coalesce(deltas, **kwargs)]
+        return asyncio.run(run())
+
+    @staticmethod
+    async def deltas(texts, gap=0.0):
+        for text in texts:
+            await asyncio.sleep(gap)
+            yield text
+
+    def test_first_delta_is_sent_alone(self):
+        async def run():
+            stream = sse.coalesce(self.deltas(['a', 'b', 'c'], gap=0.01), interval_ms=1000, max_bytes=1024)
+            started = asyncio.get_running_loop().time()
+            first = await stream.__anext__()
+            elapsed = asyncio.get_running_loop().time() - started
+            rest = [chunk async for chunk in stream]
+            return first, elapsed, rest
+
+        first, elapsed, rest = asyncio.run(run())
+        self.assertEqual(first, 'a')
+        self.assertLess(elapsed, 0.5)  # not held for the interval
+        self.assertEqual(rest, ['bc'])
+
+    def test_deltas_are_flushed_per_interval(self):
+        chunks = self.collect(self.deltas([str(n) for n in range(20)], gap=0.01), interval_ms=50, max_bytes=1024)
+        self.assertEqual(''.join(chunks), ''.join(str(n) for n in range(20)))
+        self.assertLess(len(chunks), 20)
+        self.assertGreater(len(chunks), 2)
+
+    def test_deltas_are_flushed_per_size(self):
+        chunks = self.collect(self.deltas(['ab'] * 10), interval_ms=1000, max_bytes=4)
+        self.assertEqual(chunks, ['ab'] + ['abab'] * 4 + ['ab'])
+
+    def test_zero_interval_sends_every_delta(self):
+        self.assertEqual(self.collect(self.deltas(['a', 'b', 'c']), interval_ms=0), ['a', 'b', 'c'])
+
+    def test_stream_stops_on_disconnect(self):
+        closed = []
+
+        async def endless():
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield 'x'
+            finally:
+                closed.append(True)
+
+        async def run():
+            disconnected = asyncio.Event()
+            asyncio.get_running_loop().call_later(0.1, disconnected.set)
+            return [chunk async for chunk in sse.coalesce(endless(), interval_ms=20, disconnected=disconnected)]
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual(closed, [True])
+
+
+class MemoryStreamBufferTests(SimpleTestCase):
+
+    def setUp(self):
+        self.buffer = sse.MemoryStreamBuffer(max_frames=8, ttl=60)
+        patcher = mock.patch.object(sse, 'stream_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_replay_resumes_after_the_last_event_id(self):
+        async def produce():
+            for seq in range(2, 6):
+                await self.buffer.append('key', seq, sse.sse_pack('message', {'content': seq}))
+                await asyncio.sleep(0.01)
+            await self.buffer.append('key', 6, None)
+
+        async def run():
+            await self.buffer.append('key', 1, '')  # start of the generation, written before replying
+            producer = asyncio.create_task(produce())
+            first = []
+            async for frame in sse.replay('key', 'gen'):
+                first.append(frame)
+                if len(first) == 2:
+                    break
+            generation_id, after = sse.parse_event_id(first[-1].split('\n')[0][len('id: '):])
+            await self.buffer.check('key', after)
+            rest = [frame async for frame in sse.replay('key', generation_id, after)]
+            await producer
+            return first, rest
+
+        first, rest = asyncio.run(run())
+        ids = [frame.split('\n')[0] for frame in first + rest]
+        self.assertEqual(ids, [f'id: gen:{seq}' for seq in range(2, 6)])
+
+    def test_unknown_or_evicted_frames_cannot_be_resumed(self):
+        async def run():
+            with self.assertRaises(sse.ResumeError):
+                await self.buffer.check('missing', 0)
+            for seq in range(1, 12):  # more than max_frames
+                await self.buffer.append('key', seq, 'frame')
+            await self.buffer.check('key', 5)
+            with self.assertRaises(sse.ResumeError):
+                await self.buffer.check('key', 2)
+
+        asyncio.run(run())
+
+    def test_streams_expire(self):
+        async def run():
+            await self.buffer.append('key', 1, '')
+            await self.buffer.check('key', 0)
+            with mock.patch.object(sse.time, 'monotonic', return_value=sse.time.monotonic() + 61):
+                with self.assertRaises(sse.ResumeError):
+                    await self.buffer.check('key', 0)
+
+        asyncio.run(run())
+
+
+class DeletionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.other = User.objects.create_user('bob', password='secret')
+        self.uploaded = EmbeddingDocument.objects.create(user=self.user, title='uploaded')
+        self.fetched = EmbeddingDocument.objects.create(user=self.user, title='arxiv')
+        for user in (self.user, self.other):
+            for idx in range(3):
+                conversation = Conversation.objects.create(user=user, topic=f'topic {idx}')
+                for n in range(4):
+                    Message.objects.create(conversation=conversation, user=user, message=f'message {n}', is_bot=n % 2 == 1)
+            Prompt.objects.create(user=user, title='prompt', prompt='say hi')
+        conversation = Conversation.objects.filter(user=self.user).first()
+        Message.objects.create(
+            conversation=conversation, user=self.user, message='paper',
+            message_type=Message.arxiv_context_message_type, embedding_message_doc=self.fetched,
+        )
+        Message.objects.create(
+            conversation=conversation, user=self.user, message='file',
+            message_type=Message.doc_context_message_type, embedding_message_doc=self.uploaded,
+        )
+
+    def test_delete_conversations(self):
+        with mock.patch.object(deletion, 'DELETE_BATCH_ROWS', 5):
+            counts = deletion.delete_conversations(self.user)
+        self.assertEqual(counts, {'conversations': 3, 'messages': 14, 'documents': 1})
+        self.assertFalse(Conversation.objects.filter(user=self.user).exists())
+        self.assertFalse(Message.objects.filter(user=self.user).exists())
+        # the document the arxiv tool fetched goes, the uploaded one stays
+        self.assertEqual(list(EmbeddingDocument.objects.values_list('id', flat=True)), [self.uploaded.id])
+        self.assertEqual(Conversation.objects.filter(user=self.other).count(), 3)
+        self.assertEqual(Message.objects.filter(user=self.other).count(), 12)
+
+    def test_delete_conversations_removes_stores(self):
+        with tempfile.TemporaryDirectory() as store_dir, override_settings(EMBEDDING_STORE_DIR=store_dir):
+            conversation = Conversation.objects.filter(user=self.user).first()
+            os.makedirs(os.path.join(store_dir, 'store'))
+            ConversationStore.objects.create(conversation=conversation, store_path='store')
+            deletion.delete_conversations(self.user)
+            self.assertFalse(ConversationStore.objects.exists())
+            self.assertFalse(os.path.exists(os.path.join(store_dir, 'store')))
+
+    def test_delete_documents(self):
+        counts = deletion.delete_documents(self.user)
+        self.assertEqual(counts, {'documents': 2, 'messages': 2})
+        self.assertFalse(EmbeddingDocument.objects.exists())
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 12)
+
+    def test_delete_prompts(self):
+        self.assertEqual(deletion.delete_prompts(self.user), {'prompts': 1})
+        self.assertEqual(list(Prompt.objects.values_list('user', flat=True)), [self.other.pk])
+
+    def test_progress_is_reported_per_batch(self):
+        job = Job('delete', self.user)
+        updates = []
+        with mock.patch.object(deletion, 'DELETE_BATCH_ROWS', 5), \
+                mock.patch.object(job, 'update', side_effect=lambda **state: updates.append(state)):
+            deletion.delete_conversations(self.user, job)
+        messages = [state['deleted'] for state in updates if state['stage'] == 'messages']
+        self.assertEqual(messages, [5, 10, 14])
+        self.assertEqual(updates[-1], {'stage': 'documents', 'deleted': 1})
+
+    def test_is_large(self):
+        with mock.patch.object(deletion, 'BACKGROUND_DELETE_ROWS', 14):
+            self.assertFalse(deletion.is_large(Message.objects.filter(user=self.user)))
+        with mock.patch.object(deletion, 'BACKGROUND_DELETE_ROWS', 13):
+            self.assertTrue(deletion.is_large(Message.objects.filter(user=self.user)))
+
+
+class ImportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+
+    def upload(self, conversations):
+        return io.BytesIO(json.dumps({'imports': conversations}).encode())
+
+    def conversation(self, topic, count):
+        return {
+            'conversation_topic': topic,
+            'messages': [{'role': 'user' if n % 2 == 0 else 'assistant', 'content': f'{topic} {n}'} for n in range(count)],
+        }
+
+    def test_import(self):
+        ids = transfer.import_conversations(self.user, self.upload([self.conversation('first', 3), self.conversation('second', 2)]))
+        self.assertEqual(list(Conversation.objects.filter(id__in=ids).values_list('topic', flat=True).order_by('id')), ['first', 'second'])
+        messages = Message.objects.filter(conversation_id=ids[0]).order_by('id')
+        self.assertEqual([(m.message, m.is_bot, m.user_id) for m in messages], [
+            ('first 0', False, self.user.pk), ('first 1', True, self.user.pk), ('first 2', False, self.user.pk),
+        ])
+
+    def test_import_ndjson(self):
+        lines = ''.join(json.dumps(self.conversation(topic, 2)) + '\n\n' for topic in ('first', 'second'))
+        ids = transfer.import_conversations(self.user, io.StringIO(lines), ndjson=True)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 4)
+
+    def test_conversations_without_messages_are_skipped(self):
+        ids = transfer.import_conversations(self.user, self.upload([self.conversation('empty', 0), self.conversation('full', 1)]))
+        self.assertEqual(list(Conversation.objects.filter(id__in=ids).values_list('topic', flat=True)), ['full'])
+
+    def test_batches_are_reported(self):
+        job = Job('import', self.user)
+        updates = []
+        with mock.patch.object(transfer, 'IMPORT_BATCH_MESSAGES', 4), \
+                mock.patch.object(job, 'update', side_effect=lambda **state: updates.append(state)):
+            ids = transfer.import_conversations(self.user, self.upload([self.conversation(str(n), 2) for n in range(5)]), job)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(updates, [{'conversations': 2, 'messages': 4}, {'conversations': 4, 'messages': 8}])
+
+    def test_invalid_upload_leaves_nothing(self):
+        invalid = [
+            {'conversation_topic': 'no messages'},
+            {'conversation_topic': 1, 'messages': []},
+            {'messages': [{'role': 'robot', 'content': 'hi'}]},
+            {'messages': [{'role': 'user', 'content': None}]},
+        ]
+        for conversation in invalid:
+            upload = [self.conversation(str(n), 2) for n in range(5)] + [conversation]
+            with self.subTest(conversation=conversation), mock.patch.object(transfer, 'IMPORT_BATCH_MESSAGES', 4):
+                with self.assertRaises(ValueError):
+                    transfer.import_conversations(self.user, self.upload(upload))
+                self.assertFalse(Conversation.objects.exists())
+                self.assertFalse(Message.objects.exists())
+
+    def test_malformed_json_leaves_nothing(self):
+        upload = self.upload([self.conversation(str(n), 2) for n in range(5)]).getvalue()[:-20]
+        with mock.patch.object(transfer, 'IMPORT_BATCH_MESSAGES', 4):
+            with self.assertRaises(ijson.JSONError):
+                transfer.import_conversations(self.user, io.BytesIO(upload))
+        self.assertFalse(Conversation.objects.exists())
+
+    def test_import_job_removes_the_spooled_upload(self):
+        with tempfile.NamedTemporaryFile(delete=False) as spooled:
+            spooled.write(self.upload([self.conversation('first', 2)]).getvalue())
+        result = transfer.import_job(Job('import', self.user), self.user, spooled.name)
+        self.assertEqual(result['conversations'], 1)
+        self.assertFalse(os.path.exists(spooled.name))
+
+
+class UploadConversationsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, payload):
+        return self.client.post('/api/upload_conversations/', payload, content_type='application/json')
+
+    def test_small_upload_is_imported_at_once(self):
+        response = self.post(json.dumps({'imports': [{'messages': [{'role': 'user', 'content': 'hi'}]}]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), list(Conversation.objects.values_list('id', flat=True)))
+
+    def test_invalid_upload_is_refused(self):
+        response = self.post(json.dumps({'imports': [{'messages': [{'role': 'robot', 'content': 'hi'}]}]}))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Conversation.objects.exists())
+
+    @override_settings(IMPORT_MAX_BYTES=16)
+    def test_upload_over_the_limit_is_refused(self):
+        response = self.post(json.dumps({'imports': [{'messages': [{'role': 'user', 'content': 'hi'}]}]}))
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Conversation.objects.exists())
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        other = User.objects.create_user('bob', password='secret')
+        for user in (self.user, other):
+            for idx in range(3):
+                conversation = Conversation.objects.create(user=user, topic=f'{user.username} "{idx}"')
+                for n in range(3):
+                    Message.objects.create(conversation=conversation, user=user, message=f'{idx}\n{n}', is_bot=n == 1)
+                Message.objects.create(
+                    conversation=conversation, user=user, message='Context added.', message_type=Message.temp_message_type,
+                )
+
+    def exported(self):
+        return ''.join(transfer.export_lines(self.user))
+
+    def test_one_line_per_conversation(self):
+        lines = self.exported().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {
+                'conversation_topic': f'alice "{idx}"',
+                'messages': [
+                    {'role': 'user', 'content': f'{idx}\n0'},
+                    {'role': 'assistant', 'content': f'{idx}\n1'},
+                    {'role': 'user', 'content': f'{idx}\n2'},
+                ],
+            }
+            for idx in range(3)
+        ])
+
+    def test_chunks_do_not_change_the_export(self):
+        expected = self.exported()
+        with mock.patch.object(transfer, 'EXPORT_CHUNK_ROWS', 2):
+            chunks = list(transfer.export_lines(self.user))
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(''.join(chunks), expected)
+
+    def test_nothing_to_export(self):
+        self.assertEqual(list(transfer.export_lines(User.objects.create_user('carol', password='secret'))), [])
+
+    def test_export_imports_back(self):
+        exported = self.exported()
+        Conversation.objects.filter(user=self.user).delete()
+        transfer.import_conversations(self.user, io.StringIO(exported), ndjson=True)
+        self.assertEqual(self.exported(), exported)
+
+    def test_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/api/export_conversations/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], transfer.NDJSON)
+        self.assertEqual(response.getvalue().decode(), self.exported())
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.conversations = [Conversation.objects.create(user=self.user, topic=f'topic {idx}') for idx in range(5)]
+        Conversation.objects.create(user=User.objects.create_user('bob', password='secret'), topic='not listed')
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_conversations_newest_first(self):
+        ids = self.walk('/api/chat/conversations/?page_size=2')
+        self.assertEqual(ids, [conversation.id for conversation in reversed(self.conversations)])
+
+    def test_rows_created_at_the_same_time(self):
+        created_at = self.conversations[0].created_at
+        Conversation.objects.filter(user=self.user).update(created_at=created_at)
+        ids = self.walk('/api/chat/conversations/?page_size=2')
+        self.assertEqual(ids, [conversation.id for conversation in reversed(self.conversations)])
+
+    def test_messages_of_a_conversation_oldest_first(self):
+        conversation = self.conversations[0]
+        messages = [Message.objects.create(conversation=conversation, user=self.user, message=str(n)) for n in range(5)]
+        Message.objects.create(conversation=self.conversations[1], user=self.user, message='elsewhere')
+        ids = self.walk(f'/api/chat/messages/?conversationId={conversation.id}&page_size=3')
+        self.assertEqual(ids, [message.id for message in messages])
+
+    def test_page_size_is_bounded(self):
+        response = self.client.get('/api/chat/conversations/?page_size=0')
+        self.assertEqual(len(response.data['results']), 1)
+        with mock.patch('chat.pagination.KeysetPagination.max_page_size', 3):
+            response = self.client.get('/api/chat/conversations/?page_size=100')
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/chat/conversations/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_not_modified(self):
+        url = '/api/chat/conversations/?page_size=2'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'W/"other", {etag}')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # another page of the same listing has its own tag
+        self.assertNotEqual(self.client.get('/api/chat/conversations/?page_size=3')['ETag'], etag)
+
+    def test_changes_change_the_etag(self):
+        url = '/api/chat/conversations/'
+        etags = [self.client.get(url)['ETag']]
+        conversation = self.conversations[0]
+        conversation.topic = 'renamed'
+        conversation.save()
+        etags.append(self.client.get(url)['ETag'])
+        Conversation.objects.filter(pk=self.conversations[1].pk).delete()
+        etags.append(self.client.get(url)['ETag'])
+        self.assertEqual(len(set(etags)), 3)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 3)
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.conversation = Conversation.objects.create(user=self.user, topic='topic')
+
+    def message(self, content, is_bot=False, snapshot=''):
+        return Message.objects.create(
+            conversation=self.conversation, user=self.user, message=content, is_bot=is_bot, messages=snapshot,
+        )
+
+    def test_round_trip(self):
+        first = self.message('hi')
+        answer = self.message('hello', is_bot=True)
+        prompt = [
+            {'role': 'system', 'content': 'be brief'},
+            {'role': 'user', 'content': 'hi'},
+            {'role': 'assistant', 'content': 'hello'},
+            {'role': 'user', 'content': 'how are you?'},
+        ]
+        snapshot = prompt_snapshot(prompt, [first.id, answer.id, None])
+        self.assertEqual(json.loads(snapshot)['ids'], [first.id, answer.id])
+        store_system_prompt('be brief')
+        store_system_prompt('be brief')
+        self.assertEqual(SystemPrompt.objects.count(), 1)
+        self.assertEqual(load_snapshot(self.message('how are you?', snapshot=snapshot)), prompt)
+
+    def test_messages_after_a_missing_row_stay_inline(self):
+        first = self.message('hi')
+        prompt = [{'role': 'user', 'content': 'hi'}, {'role': 'user', 'content': 'rewritten'}, {'role': 'user', 'content': 'again'}]
+        snapshot = json.loads(prompt_snapshot(prompt, [first.id, None, None]))
+        self.assertEqual(snapshot, {'v': SNAPSHOT_VERSION, 'system': None, 'ids': [first.id], 'tail': prompt[1:]})
+
+    def test_deleted_rows_and_system_prompts_are_skipped(self):
+        first = self.message('hi')
+        snapshot = prompt_snapshot([{'role': 'system', 'content': 'never stored'}, {'role': 'user', 'content': 'hi'}], [first.id])
+        message = self.message('next', snapshot=snapshot)
+        self.assertEqual(load_snapshot(message), [{'role': 'user', 'content': 'hi'}])
+        first.delete()
+        self.assertEqual(load_snapshot(message), [])
+
+    def test_legacy_snapshots(self):
+        prompt = [{'role': 'user', 'content': "it's"}]
+        self.assertEqual(parse_legacy_snapshot(json.dumps(prompt)), prompt)
+        self.assertEqual(parse_legacy_snapshot(str(prompt)), prompt)
+        for value in ('', 'not a prompt', '{"role": "user"}', '[' * 10000):
+            self.assertIsNone(parse_legacy_snapshot(value))
+        self.assertEqual(load_snapshot(self.message('hi', snapshot=str(prompt))), prompt)
+        self.assertEqual(load_snapshot(self.message('hi', snapshot='garbage')), [])
+        self.assertEqual(load_snapshot(self.message('hi')), [])
+
+    def test_compaction(self):
+        migration = importlib.import_module('chat.migrations.0014_systemprompt_compact_snapshots').Migration
+        system = {'role': 'system', 'content': 'be brief'}
+        first_prompt = [system, {'role': 'user', 'content': 'hi'}]
+        second_prompt = [
+            system,
+            {'role': 'user', 'content': 'hi'},
+            {'role': 'assistant', 'content': 'hello'},
+            {'role': 'user', 'content': 'paper [context]'},
+            {'role': 'user', 'content': 'summarize'},
+        ]
+        first = self.message('hi', snapshot=str(first_prompt))
+        self.message('hello', is_bot=True)
+        second = self.message('summarize', snapshot=json.dumps(second_prompt))
+        broken = self.message('broken', snapshot='[{')
+
+        migration.compact_snapshots(apps, None)
+
+        for message, prompt in ((first, first_prompt), (second, second_prompt)):
+            message.refresh_from_db()
+            self.assertEqual(json.loads(message.messages)['v'], SNAPSHOT_VERSION)
+            self.assertEqual(load_snapshot(message), prompt)
+        self.assertEqual(json.loads(second.messages)['tail'], second_prompt[3:])
+        broken.refresh_from_db()
+        self.assertEqual(broken.messages, '')
+        self.assertEqual(list(SystemPrompt.objects.values_list('content', flat=True)), ['be brief'])
+
+        # compacted snapshots are left as they are
+        compacted = second.messages
+        migration.compact_snapshots(apps, None)
+        second.refresh_from_db()
+        self.assertEqual(second.messages, compacted)
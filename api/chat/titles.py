@@ -0,0 +1,198 @@
+"""
+Background generation of conversation titles
+
+A title is requested when the first answer of a conversation is persisted.
+Requests are queued and handled by a bounded pool of workers, which name up
+to TITLE_BATCH_SIZE conversations of a user sharing an API key with a single
+call. Contents of different users never share a prompt.
+Generated titles are stored on the conversation and kept in the cache.
+"""
+import os
+import re
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+import openai
+from django.core.cache import cache
+from django.db import connections
+from django.utils import timezone
+
+from provider.scheduler import api_key_scheduler
+from stats.usage import usage_writer, increase_token_usage
+from .config import settings_cache
+from .llm import get_openai_client
+from .models import Conversation
+
+logger = logging.getLogger(__name__)
+
+TITLE_MODEL = os.getenv('TITLE_MODEL', 'gpt-3.5-turbo')
+TITLE_WORKERS = 2
+TITLE_BATCH_SIZE = 8
+TITLE_QUEUE_SIZE = 1000
+TITLE_CACHE_SECONDS = 24 * 3600
+TITLE_CONTENT_CHARS = 2000  # of the first message, enough to name it
+DEFAULT_TITLE_PROMPT = 'Generate a short title for the following content, no more than 10 words. \n\nContent: '
+UNTITLED = 'Untitled Conversation'
+
+_numbered_line = re.compile(r'^\s*(\d+)[.):]\s*(.+)$')
+
+
+def _title_key(conversation_id):
+    return f'title:{conversation_id}'
+
+
+def cached_title(conversation_id):
+    return cache.get(_title_key(conversation_id))
+
+
+def _clean(title):
+    return title.strip().replace('"', '')[:255]
+
+
+def _shares(total, count):
+    """split total into count integer shares, the remainder going to the first"""
+    share = total // count
+    return [total - share * (count - 1)] + [share] * (count - 1)
+
+
+class _TitleRequest:
+    def __init__(self, conversation_id, user, content, prompt, openai_api_key):
+        self.conversation_id = conversation_id
+        self.user = user
+        self.content = content[:TITLE_CONTENT_CHARS]
+        self.prompt = prompt or DEFAULT_TITLE_PROMPT
+        self.openai_api_key = openai_api_key
+        self.future = Future()
+
+
+class TitleQueue:
+    """bounded queue of title requests, one pending request per conversation"""
+
+    def __init__(self, workers=TITLE_WORKERS, batch_size=TITLE_BATCH_SIZE, maxsize=TITLE_QUEUE_SIZE):
+        self.workers = workers
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._pending = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, conversation_id, user, content, prompt=None, openai_api_key=None):
+        """return a future of the title of a conversation, None when it cannot be generated"""
+        with self._lock:
+            request = self._pending.get(conversation_id)
+            if request is not None:
+                return request.future
+            request = self._pending[conversation_id] = _TitleRequest(conversation_id, user, content, prompt, openai_api_key)
+            if not self._threads:
+                for idx in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f'title-{idx}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            logger.warning('title queue is full, conversation %s is not named', conversation_id)
+            self._resolve(request, None)
+        return request.future
+
+    def _resolve(self, request, title):
+        with self._lock:
+            self._pending.pop(request.conversation_id, None)
+        if request.future.set_running_or_notify_cancel():
+            request.future.set_result(title)
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.user.pk, request.openai_api_key, request.prompt), []).append(request)
+            for group in groups.values():
+                try:
+                    titles = self._generate(group)
+                except Exception as e:
+                    logger.error('cannot generate titles %s', e)
+                    titles = [UNTITLED] * len(group)
+                finally:
+                    connections.close_all()  # this thread is not managed by Django
+                for request, title in zip(group, titles):
+                    self._resolve(request, title)
+
+    @staticmethod
+    def _prompt(group):
+        if len(group) == 1:
+            return group[0].prompt + group[0].content
+        contents = '\n\n'.join(f'{idx}. {request.content}' for idx, request in enumerate(group, 1))
+        return (
+            f'{group[0].prompt}\n\nThere are {len(group)} contents, numbered. '
+            f'Answer with one title per line, numbered the same way.\n\n{contents}'
+        )
+
+    def _generate(self, group):
+        api_key = None
+        openai_api_key = group[0].openai_api_key or settings_cache.get('openai_api_key') or None
+        if openai_api_key is None:
+            api_key = api_key_scheduler.acquire()
+            if api_key is None:
+                logger.warning('there is no available API key to generate titles')
+                return [UNTITLED] * len(group)
+            openai_api_key = api_key.key
+
+        started = time.perf_counter()
+        try:
+            response = get_openai_client(openai_api_key, os.getenv('OPENAI_API_PROXY')).ChatCompletion.create(
+                model=TITLE_MODEL,
+                messages=[{"role": "user", "content": self._prompt(group)}],
+                max_tokens=64 * len(group),
+                temperature=0.5,
+            )
+        except openai.error.RateLimitError:
+            api_key_scheduler.cooldown(api_key)
+            raise
+        finally:
+            api_key_scheduler.release(api_key)
+
+        text = response['choices'][0]['message']['content']
+        if len(group) == 1:
+            titles = [_clean(text)]
+        else:
+            numbered = {}
+            for line in text.splitlines():
+                match = _numbered_line.match(line)
+                if match:
+                    numbered[int(match.group(1))] = _clean(match.group(2))
+            titles = [numbered.get(idx) or UNTITLED for idx in range(1, len(group) + 1)]
+
+        usage = response['usage']
+        latency_ms = (time.perf_counter() - started) * 1000
+        # the call is shared, so is its usage
+        shares = zip(
+            _shares(usage['total_tokens'], len(group)),
+            _shares(usage['prompt_tokens'], len(group)),
+            _shares(usage['completion_tokens'], len(group)),
+        )
+        for request, title, (total_tokens, prompt_tokens, completion_tokens) in zip(group, titles, shares):
+            increase_token_usage(request.user, total_tokens, api_key)
+            usage_writer.record(
+                request.user, response['model'],
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                latency_ms=latency_ms,
+                api_key=api_key,
+            )
+            # a title given by the user meanwhile is kept
+            Conversation.objects.filter(id=request.conversation_id, topic='').update(topic=title, updated_at=timezone.now())
+            cache.set(_title_key(request.conversation_id), title, TITLE_CACHE_SECONDS)
+        usage_writer.flush_due()
+        return titles
+
+
+title_queue = TitleQueue()
@@ -2,17 +2,26 @@
 Message tools
 """
 import os
+import re
 import sys
+import uuid
 import pickle
 import json
+import asyncio
 import logging
 import hashlib
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
 import arxiv
+from django.core.cache import cache
+from django.db import connections
 from langchain.schema import Document
 from .models import Conversation, Message, Setting, Prompt, EmbeddingDocument
-from .llm import text_splitter, embedding_model, pickle_faiss
+from .llm import text_splitter
+from .vectorstore import save_faiss, copy_faiss, delete_faiss, store_exists
 
 logger = logging.getLogger(__name__)
 
@@ -34,22 +43,118 @@ arxiv_client = arxiv.Client(
   num_retries = 2,
 )
 
+ARXIV_CACHE_SECONDS = int(os.getenv('ARXIV_CACHE_SECONDS', 7 * 24 * 3600))
+ARXIV_DOWNLOAD_WORKERS = 4
+EMBEDDING_BATCH_SIZE = 64
+_versioned_id = re.compile(r'v\d+$')
+
+tool_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='tool')
+
+
+class ToolJob:
+    """a tool running in the background while the chat stream reports its progress"""
+
+    def __init__(self, func, *args):
+        self.events = []
+        self.future = tool_executor.submit(contextvars.copy_context().run, self._run, func, *args)
+
+    def _run(self, func, *args):
+        try:
+            return func(self, *args)
+        finally:
+            connections.close_all()  # this thread is not managed by Django
+
+    def report(self, stage, **data):
+        self.events.append({'stage': stage, **data})
+
+    async def progress(self, interval=0.5):
+        """yield the progress events until the job is done"""
+        sent = 0
+        future = asyncio.wrap_future(self.future)
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=interval)
+            while sent < len(self.events):
+                yield self.events[sent]
+                sent += 1
+            if done:
+                return
+
+    def result(self):
+        return self.future.result()
+
+
 def _hacky_hash(some_string):
     _hash = hashlib.md5(some_string.encode("utf-8")).hexdigest()
     return _hash
 
+
+def _arxiv_cache_key(short_id):
+    return f'arxiv:{short_id}'
+
+
+def _arxiv_store_path(short_id):
+    """the cached FAISS store of a paper version, shared by all users"""
+    return os.path.join('arxiv', short_id.replace('/', '_'))
+
+
+def _arxiv_metadata(result, load_all_available_meta=False):
+    add_meta = (
+        {
+            "entry_id": result.entry_id,
+            "published_first_time": str(result.published.date()),
+            "comment": result.comment,
+            "journal_ref": result.journal_ref,
+            "doi": result.doi,
+            "primary_category": result.primary_category,
+            "categories": result.categories,
+            "links": [link.href for link in result.links],
+        }
+        if load_all_available_meta
+        else {}
+    )
+    return {
+        "Published": str(result.updated.date()),
+        "Title": result.title,
+        "Authors": ", ".join(
+            a.name for a in result.authors
+        ),
+        "Summary": result.summary,
+        **add_meta,
+    }
+
+
+def _arxiv_download(result, papers_dir, load_all_available_meta=False):
+    """download a paper and extract its text, or take the text from the cache"""
+    import fitz
+
+    key = _arxiv_cache_key(result.get_short_id())
+    cached = cache.get(key)
+    if cached is not None:
+        text = cached['page_content']
+    else:
+        filename = f"{_hacky_hash(result.title)}.pdf"
+        result.download_pdf(dirpath=papers_dir, filename=filename)
+        logging.debug(f"> Downloading {filename}...")
+        with fitz.open(os.path.join(papers_dir, filename)) as doc_file:
+            text: str = "".join(page.get_text() for page in doc_file)
+        cache.set(key, {'page_content': text, 'metadata': _arxiv_metadata(result, True)}, ARXIV_CACHE_SECONDS)
+    return Document(page_content=text, metadata=_arxiv_metadata(result, load_all_available_meta))
+
+
 def _arxiv_load(
     query: Optional[str] ='',
     id_list: Optional[str|List[str]] = [],
     max_results: int = 2,
     sort_by: Optional[Any] = arxiv.SortCriterion.Relevance,
-    papers_dir: Optional[str] = ".papers",
     load_all_available_meta: bool = False,
 ) -> List[Document]:
     """
     Run Arxiv search and get the PDF documents plus the meta information.
     See https://lukasschwab.me/arxiv.py/index.html#Search
 
+    The papers are downloaded concurrently into a temporary directory of the
+    request, and their text is cached per arxiv id and version.
+
     Returns: a list of documents with the document.page_content in PDF format
 
     """
@@ -69,7 +174,6 @@ def _arxiv_load(
         )
 
     try:
-        docs: List[Document] = []
         arxiv_search = arxiv.Search(
             query=query,
             id_list=id_list,
@@ -77,61 +181,21 @@ def _arxiv_load(
             sort_by=sort_by
         )
         search_results = list(arxiv_client.results(arxiv_search))
+        if not search_results:
+            return []
 
-        if not os.path.exists(papers_dir):
-            os.makedirs(papers_dir)
-
-        for result in search_results:
-            try:
-                paper = result
-                filename = f"{_hacky_hash(result.title)}.pdf"
-                doc_file_name: str = os.path.join(papers_dir, filename)
-                paper.download_pdf(dirpath=papers_dir, filename=filename)
-                logging.debug(f"> Downloading {filename}...")
-                with fitz.open(doc_file_name) as doc_file:
-                    text: str = "".join(page.get_text() for page in doc_file)
-                    add_meta = (
-                        {
-                            "entry_id": result.entry_id,
-                            "published_first_time": str(result.published.date()),
-                            "comment": result.comment,
-                            "journal_ref": result.journal_ref,
-                            "doi": result.doi,
-                            "primary_category": result.primary_category,
-                            "categories": result.categories,
-                            "links": [link.href for link in result.links],
-                        }
-                        if load_all_available_meta
-                        else {}
-                    )
-                    doc = Document(
-                        page_content=text,
-                        metadata=(
-                            {
-                                "Published": str(result.updated.date()),
-                                "Title": result.title,
-                                "Authors": ", ".join(
-                                    a.name for a in result.authors
-                                ),
-                                "Summary": result.summary,
-                                **add_meta,
-                            }
-                        ),
-                    )
-                    docs.append(doc)
-            except FileNotFoundError as f_ex:
-                logger.debug(f_ex)
-
-        # Delete downloaded papers
-        try:
-            for f in os.listdir(papers_dir):
-                os.remove(os.path.join(papers_dir, f))
-                logging.debug(f"> Deleted file: {f}")
-            #os.rmdir(papers_dir)
-            logging.debug(f"> Deleted directory: {papers_dir}")
-        except OSError:
-            print("Unable to delete files")
-
+        docs: List[Document] = []
+        with tempfile.TemporaryDirectory(prefix='arxiv-') as papers_dir:
+            with ThreadPoolExecutor(max_workers=min(len(search_results), ARXIV_DOWNLOAD_WORKERS)) as executor:
+                futures = [
+                    executor.submit(_arxiv_download, result, papers_dir, load_all_available_meta)
+                    for result in search_results
+                ]
+                for future in futures:
+                    try:
+                        docs.append(future.result())
+                    except FileNotFoundError as f_ex:
+                        logger.debug(f_ex)
         return docs
 
     except Exception as ex:
@@ -139,44 +203,83 @@ def _arxiv_load(
         return []
 
 
-def _arxiv(message, args):
-    """Dowload arxiv PDF and embedding it"""
-    
-    from langchain.vectorstores import FAISS
+def _arxiv_cached_paper(ID):
+    """return the cached text of a versioned arxiv id without querying arxiv"""
+    if not _versioned_id.search(ID):
+        return None
+    cached = cache.get(_arxiv_cache_key(ID))
+    if cached is None or not store_exists(_arxiv_store_path(ID)):
+        return None
+    return Document(page_content=cached['page_content'], metadata=cached['metadata'])
 
-    ID =  message.strip()
-    message = '[arxiv] ' + ID
 
-    logger.debug('process arxiv message %s : %s', message, args)
+def _arxiv_embed(job, short_id, docs, embeddings):
+    """return the cached store of a paper version, embedding it in batches if needed"""
+    from langchain.vectorstores import FAISS
 
-    try:
-        docs = _arxiv_load(id_list=[ID], max_results=1)
-        if len(docs) == 0:
-            raise RuntimeError()
-    except Exception as e:
-        logger.error('cannot download %s', ID)
-        return f'Failed to download ArXiv: {ID}'
+    store_path = _arxiv_store_path(short_id)
+    if store_exists(store_path):
+        return store_path
 
-    logger.debug('Download %d arxiv documents', len(docs))
     documents = text_splitter.split_documents(docs)
-    db = FAISS.from_documents(documents, embedding_model.function)
-    faiss_store = pickle_faiss(db)
+    db = None
+    for start in range(0, len(documents), EMBEDDING_BATCH_SIZE):
+        batch = documents[start:start + EMBEDDING_BATCH_SIZE]
+        if db is None:
+            db = FAISS.from_documents(batch, embeddings)
+        else:
+            db.add_documents(batch)
+        job.report('embed', done=start + len(batch), total=len(documents))
+    tmp_path = save_faiss(db, 'arxiv')
+    try:
+        return copy_faiss(tmp_path, store_path)
+    finally:
+        delete_faiss(tmp_path)
 
+
+def _arxiv_job(job, ID, user, openai_client):
+    """download, cache and embed a paper, then attach it to the user as a document"""
+    job.report('download', id=ID)
+    doc = _arxiv_cached_paper(ID)
+    if doc is not None:
+        short_id = ID
+    else:
+        docs = _arxiv_load(id_list=[ID], max_results=1, load_all_available_meta=True)
+        if len(docs) == 0:
+            logger.error('cannot download %s', ID)
+            raise RuntimeError(f'Failed to download ArXiv: {ID}')
+        doc = docs[0]
+        short_id = doc.metadata.get('entry_id', '').rsplit('/abs/', 1)[-1] or ID
+    logger.debug('Download arxiv document %s', short_id)
+
+    title = doc.metadata['Title']
+    job.report('embed', done=0, title=title)
+    store_path = _arxiv_embed(job, short_id, [doc], openai_client.embeddings)
     doc_obj = EmbeddingDocument(
-        user=args['user'],
-        faiss_store=faiss_store,
-        title=docs[0].metadata['Title'],
+        user=user,
+        store_path=copy_faiss(store_path, os.path.join(str(user.id), uuid.uuid4().hex)),
+        title=title,
     )
     doc_obj.save()
-    args['embedding_doc_id'] = doc_obj.id
-    args['doc_title'] = docs[0].metadata['Title']
+    job.report('done', title=title)
+    return {'embedding_doc_id': doc_obj.id, 'doc_title': title}
+
+
+def _arxiv(message, args):
+    """Dowload arxiv PDF and embedding it, in the background
 
-    message += ' [Title] ' + docs[0].metadata['Title']
+    args['job'] resolves to the id and title of the new EmbeddingDocument.
+    """
+    ID =  message.strip()
+    message = '[arxiv] ' + ID
+
+    logger.debug('process arxiv message %s : %s', message, args)
 
+    args['job'] = ToolJob(_arxiv_job, ID, args['user'], args['openai_client'])
     return message
 
 
 TOOL_LIST = {
     'web_search': _web_search,
     'arxiv': _arxiv,
-}
\ No newline at end of file
+}
@@ -0,0 +1,153 @@
+"""
+Import and export of conversations
+
+An upload is parsed incrementally with ijson and written with bulk_create in
+transactional batches, so neither the payload nor the rows are held in memory
+as a whole. When the upload turns out to be invalid partway through, the
+batches already written are deleted again: an import is complete or absent.
+An export is streamed as NDJSON from a server-side cursor: one line per
+conversation, each line in the shape of an item of the import.
+"""
+import os
+import json
+import logging
+
+import ijson
+from django.db import connection, transaction
+
+from .models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_MESSAGES = 2000
+EXPORT_CHUNK_ROWS = 1000
+ROLES = ('user', 'assistant', 'system')
+NDJSON = 'application/x-ndjson'
+
+
+def _ndjson_items(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_imports(stream, ndjson=False):
+    """yield (topic, [(role, content)]) for the conversations of an upload, validated one by one
+
+    The upload is either {"imports": [conversation, ...]} or, with ndjson, one
+    conversation per line as written by export_lines.
+    """
+    items = _ndjson_items(stream) if ndjson else ijson.items(stream, 'imports.item')
+    for idx, conversation in enumerate(items):
+        if not isinstance(conversation, dict) or not isinstance(conversation.get('messages'), list):
+            raise ValueError(f'conversation {idx} has no messages')
+        topic = conversation.get('conversation_topic') or ''
+        if not isinstance(topic, str):
+            raise ValueError(f'conversation {idx} has an invalid topic')
+        messages = []
+        for message in conversation['messages']:
+            if not isinstance(message, dict) or message.get('role') not in ROLES or not isinstance(message.get('content'), str):
+                raise ValueError(f'conversation {idx} has an invalid message')
+            messages.append((message['role'], message['content']))
+        if messages:
+            yield topic[:255], messages
+
+
+def _write_batch(user, batch):
+    """write a batch of conversations and their messages, return the conversation ids"""
+    with transaction.atomic():
+        conversations = [Conversation(user=user, topic=topic) for topic, _ in batch]
+        if connection.features.can_return_rows_from_bulk_insert:
+            Conversation.objects.bulk_create(conversations)
+        else:  # the ids are needed by the messages
+            for conversation in conversations:
+                conversation.save()
+        Message.objects.bulk_create([
+            Message(user=user, conversation=conversation, message=content, is_bot=role != 'user')
+            for conversation, (_, messages) in zip(conversations, batch)
+            for role, content in messages
+        ], batch_size=IMPORT_BATCH_MESSAGES)
+    return [conversation.id for conversation in conversations]
+
+
+def _discard(conversation_ids):
+    """delete the conversations of a failed import, with their messages"""
+    for start in range(0, len(conversation_ids), IMPORT_BATCH_MESSAGES):
+        with transaction.atomic():
+            Conversation.objects.filter(pk__in=conversation_ids[start:start + IMPORT_BATCH_MESSAGES]).delete()
+
+
+def import_conversations(user, stream, job=None, ndjson=False):
+    """import the conversations of an upload, return their ids
+
+    Each batch of about IMPORT_BATCH_MESSAGES messages is committed on its own
+    and reported to job, if given. On any error the conversations imported so
+    far are deleted and the error is raised.
+    """
+    conversation_ids = []
+    messages_count = 0
+    batch = []
+    batch_messages = 0
+    try:
+        for topic, messages in iter_imports(stream, ndjson):
+            batch.append((topic, messages))
+            batch_messages += len(messages)
+            if batch_messages >= IMPORT_BATCH_MESSAGES:
+                conversation_ids += _write_batch(user, batch)
+                messages_count += batch_messages
+                batch, batch_messages = [], 0
+                if job is not None:
+                    job.update(conversations=len(conversation_ids), messages=messages_count)
+        if batch:
+            conversation_ids += _write_batch(user, batch)
+            messages_count += batch_messages
+    except Exception:
+        if conversation_ids:
+            logger.debug('import failed, deleting %d conversations', len(conversation_ids))
+            _discard(conversation_ids)
+        raise
+    logger.debug('imported %d conversations, %d messages', len(conversation_ids), messages_count)
+    return conversation_ids
+
+
+def import_job(job, user, path, ndjson=False):
+    """background import of an upload spooled to path"""
+    try:
+        with open(path, 'rb') as stream:
+            conversation_ids = import_conversations(user, stream, job, ndjson)
+    finally:
+        os.remove(path)
+    return {'conversations': len(conversation_ids), 'conversation_ids': conversation_ids}
+
+
+def export_lines(user):
+    """yield the NDJSON export of the conversations of a user, a chunk of rows at a time
+
+    Conversations are written message by message, so memory stays constant
+    whatever their length.
+    """
+    rows = (
+        Message.objects.filter(conversation__user=user)
+        .exclude(message_type=Message.temp_message_type)
+        .order_by('conversation_id', 'created_at', 'id')
+        .values_list('conversation_id', 'conversation__topic', 'is_bot', 'message')
+        .iterator(chunk_size=EXPORT_CHUNK_ROWS)
+    )
+    current = None
+    parts = []
+    for conversation_id, topic, is_bot, content in rows:
+        if conversation_id != current:
+            if current is not None:
+                parts.append(']}\n')
+            parts.append('{"conversation_topic": %s, "messages": [' % json.dumps(topic))
+            current = conversation_id
+        else:
+            parts.append(', ')
+        parts.append(json.dumps({'role': 'assistant' if is_bot else 'user', 'content': content}))
+        if len(parts) >= EXPORT_CHUNK_ROWS:
+            yield ''.join(parts)
+            parts = []
+    if current is not None:
+        parts.append(']}\n')
+    if parts:
+        yield ''.join(parts)
@@ -0,0 +1,238 @@
+"""
+On-disk storage and process-wide cache of FAISS vector stores
+
+A store lives in its own directory under EMBEDDING_STORE_DIR: the raw FAISS
+index, opened memory-mapped, next to a columnar JSON docstore. Only the
+relative directory is kept on EmbeddingDocument.store_path.
+"""
+import os
+import json
+import uuid
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+
+import faiss
+from django.conf import settings
+from django.db import transaction
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+
+from .models import EmbeddingDocument, ConversationStore
+from .llm import embed_query, unpick_faiss
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.faiss'
+DOCSTORE_FILE = 'docstore.json'
+
+
+def _store_dir(store_path):
+    return os.path.join(settings.EMBEDDING_STORE_DIR, store_path)
+
+
+def write_store(store_path, index, docstore, index_to_docstore_id):
+    """write an index and its docstore into store_path, atomically"""
+    target = _store_dir(store_path)
+    tmp = target + '.tmp'
+    os.makedirs(tmp)
+    faiss.write_index(index, os.path.join(tmp, INDEX_FILE))
+    ids = [index_to_docstore_id[i] for i in range(len(index_to_docstore_id))]
+    docs = [docstore.search(i) for i in ids]
+    columns = {
+        'ids': ids,
+        'page_content': [doc.page_content for doc in docs],
+        'metadata': [doc.metadata for doc in docs],
+    }
+    with open(os.path.join(tmp, DOCSTORE_FILE), 'w') as f:
+        json.dump(columns, f, default=str)
+    os.replace(tmp, target)
+
+
+def save_faiss(db, prefix):
+    """write a vector store to disk under prefix and return its store_path"""
+    store_path = os.path.join(str(prefix), uuid.uuid4().hex)
+    write_store(store_path, db.index, db.docstore, db.index_to_docstore_id)
+    return store_path
+
+
+def load_faiss(store_path, embedding_func=None):
+    """open a vector store written by save_faiss, with the index memory-mapped"""
+    target = _store_dir(store_path)
+    index = faiss.read_index(os.path.join(target, INDEX_FILE), faiss.IO_FLAG_MMAP)
+    with open(os.path.join(target, DOCSTORE_FILE)) as f:
+        columns = json.load(f)
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=page_content, metadata=metadata)
+        for doc_id, page_content, metadata in zip(columns['ids'], columns['page_content'], columns['metadata'])
+    })
+    return FAISS(embedding_func.embed_query if embedding_func else embed_query, index, docstore, dict(enumerate(columns['ids'])))
+
+
+def store_exists(store_path):
+    return os.path.isfile(os.path.join(_store_dir(store_path), DOCSTORE_FILE))
+
+
+def copy_faiss(store_path, target_path):
+    """copy a store to target_path, atomically, and return target_path
+
+    A target written meanwhile by a concurrent copy is kept.
+    """
+    target = _store_dir(target_path)
+    tmp = f'{target}.{uuid.uuid4().hex}.tmp'
+    shutil.copytree(_store_dir(store_path), tmp)
+    try:
+        os.replace(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return target_path
+
+
+def store_size(store_path):
+    target = _store_dir(store_path)
+    return sum(os.path.getsize(os.path.join(target, name)) for name in (INDEX_FILE, DOCSTORE_FILE))
+
+
+def delete_faiss(store_path):
+    if store_path:
+        shutil.rmtree(_store_dir(store_path), ignore_errors=True)
+
+
+class FaissStoreCache:
+    """LRU of vector stores, bounded by the size of their serialized form"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._stores = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """return a (store, size) entry or None"""
+        with self._lock:
+            entry = self._stores.get(key)
+            if entry is not None:
+                self._stores.move_to_end(key)
+            return entry
+
+    def put(self, key, store, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._stores.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._stores[key] = (store, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                evicted_key, (_, evicted_size) = self._stores.popitem(last=False)
+                self._size -= evicted_size
+                logger.debug('evict faiss store %s', evicted_key)
+
+    def clear(self):
+        with self._lock:
+            self._stores.clear()
+            self._size = 0
+
+
+faiss_cache = FaissStoreCache(settings.FAISS_CACHE_MAX_BYTES)
+
+
+def clone_faiss(db):
+    """copy a store so merging into it leaves the cached original untouched"""
+    return FAISS(
+        db.embedding_function,
+        faiss.clone_index(db.index),
+        InMemoryDocstore(dict(db.docstore._dict)),
+        dict(db.index_to_docstore_id),
+    )
+
+
+def _load_document_store(key):
+    entry = faiss_cache.get(key)
+    if entry is None:
+        _, doc_id, _ = key
+        store_path = EmbeddingDocument.objects.filter(id=doc_id).values_list('store_path', flat=True).first()
+        if store_path:
+            entry = (load_faiss(store_path), store_size(store_path))
+        else:  # legacy row, not moved to disk yet
+            pickled = EmbeddingDocument.objects.filter(id=doc_id).values_list('faiss_store', flat=True).first()
+            if not pickled:
+                return None
+            entry = (unpick_faiss(bytes(pickled)), len(pickled))
+        faiss_cache.put(key, *entry)
+        logger.debug('document %s loaded', doc_id)
+    return entry
+
+
+def _indexed_doc_ids(store):
+    return [int(doc_id) for doc_id in store.doc_ids.split(',') if doc_id]
+
+
+def add_conversation_documents(conversation_id, doc_ids):
+    """merge documents into the persisted index of a conversation
+
+    Only the documents that are not indexed yet are merged, into a copy of the
+    current composite index, which is then written to a new store_path.
+    """
+    doc_ids = [int(doc_id) for doc_id in doc_ids]
+    with transaction.atomic():
+        store, _ = ConversationStore.objects.select_for_update().get_or_create(conversation_id=conversation_id)
+        indexed = _indexed_doc_ids(store)
+        missing = [doc_id for doc_id in doc_ids if doc_id not in indexed]
+        if not missing:
+            return store
+
+        markers = dict(EmbeddingDocument.objects.filter(id__in=missing).values_list('id', 'updated_at'))
+        stores = []
+        for doc_id in missing:
+            entry = _load_document_store(('doc', doc_id, markers[doc_id])) if doc_id in markers else None
+            if entry is not None:
+                stores.append(entry[0])
+                indexed.append(doc_id)
+        if not stores:
+            return store
+
+        if store.store_path:
+            merged = clone_faiss(load_faiss(store.store_path))
+        else:
+            merged = clone_faiss(stores.pop(0))
+        for vector_store in stores:
+            merged.merge_from(vector_store)
+
+        old_store_path = store.store_path
+        store.store_path = save_faiss(merged, 'conversations')
+        store.doc_ids = ','.join(str(doc_id) for doc_id in indexed)
+        store.save()
+        transaction.on_commit(lambda: delete_faiss(old_store_path))
+    logger.debug('conversation %s indexed documents %s', conversation_id, store.doc_ids)
+    return store
+
+
+def get_conversation_store(conversation_id, doc_ids):
+    """return the composite vector store of the documents attached to a conversation
+
+    The composite index is persisted and cached per (conversation id, updated_at);
+    documents it does not cover yet are merged into it once.
+    """
+    doc_ids = [int(doc_id) for doc_id in doc_ids]
+    store = ConversationStore.objects.filter(conversation_id=conversation_id).first()
+    if store is None or not set(doc_ids) <= set(_indexed_doc_ids(store)):
+        store = add_conversation_documents(conversation_id, doc_ids)
+    if not store.store_path:
+        return None
+
+    key = ('conversation', conversation_id, store.updated_at)
+    entry = faiss_cache.get(key)
+    if entry is None:
+        entry = (load_faiss(store.store_path), store_size(store.store_path))
+        faiss_cache.put(key, *entry)
+    return entry[0]
+
+
+def invalidate_conversation_stores(**filters):
+    """drop the composite indexes matching filters, they are rebuilt on the next turn"""
+    for store in ConversationStore.objects.filter(**filters).distinct():
+        store.delete()
@@ -1,3 +1,4 @@
+import io
 import os
 import sys
 import asyncio
@@ -9,43 +10,76 @@ import uuid
 import openai
 import time
 import datetime
+import functools
+import itertools
+import contextvars
 import tiktoken
 import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from provider.models import ApiKey
-from stats.models import TokenUsage
+from provider.scheduler import api_key_scheduler
+from stats.metrics import RequestTimer, aggregates, timed
+from stats.usage import usage_writer, increase_token_usage
 from .models import Conversation, Message, EmbeddingDocument, Setting, Prompt
 from django.conf import settings
-from django.http import StreamingHttpResponse
-from django.forms.models import model_to_dict
-from rest_framework import viewsets, status
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse, JsonResponse, HttpResponseNotAllowed
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from rest_framework import viewsets, status, exceptions
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.decorators import api_view, authentication_classes, permission_classes, action
+from .pagination import KeysetPagination, ConditionalListMixin
 from .serializers import ConversationSerializer, MessageSerializer, PromptSerializer, EmbeddingDocumentSerializer, SettingSerializer
 from utils.search_prompt import compile_prompt
 from utils.duckduckgo_search import web_search, SearchRequest
 from .tools import TOOL_LIST
-from .llm import get_embedding_document, unpick_faiss, langchain_doc_chat
-from .llm import setup_openai_env as llm_openai_env
-from .llm import setup_openai_model as llm_openai_model
+from .llm import get_embedding_document, langchain_doc_chat
+from .deletion import delete_conversations, delete_documents, delete_prompts, delete_job, is_large
+from .config import settings_cache
+from .jobs import start_job, get_job
+from .transfer import NDJSON, import_conversations, import_job, export_lines
+from .titles import title_queue, cached_title, UNTITLED
+from .sse import (
+    sse_pack, coalesce, client_disconnected, until_disconnected,
+    stream_buffer, stream_key, parse_event_id, replay, publish, ResumeError,
+)
+from .snapshots import prompt_snapshot, store_system_prompt
+from .vectorstore import get_conversation_store, add_conversation_documents, save_faiss, delete_faiss
+from .llm import get_openai_client, use_openai_client, get_current_openai_client
+from .llm import use_openai_model
 
 
 logger = logging.getLogger(__name__)
 
+IMPORT_INLINE_BYTES = 2 * 1024 * 1024  # larger uploads are imported in the background
+UPLOAD_CHUNK_BYTES = 64 * 1024
+TITLE_WAIT_SECONDS = 15  # how long a new conversation waits for its title
+
 class SettingViewSet(viewsets.ModelViewSet):
     serializer_class = SettingSerializer
     # permission_classes = [IsAuthenticated]
 
+    available_names = [
+        'open_registration',
+        'open_web_search',
+        'open_api_key_setting',
+        'open_frugal_mode_control',
+    ]
+
     def get_queryset(self):
-        available_names = [
-            'open_registration',
-            'open_web_search',
-            'open_api_key_setting',
-            'open_frugal_mode_control',
-        ]
-        return Setting.objects.filter(name__in=available_names)
+        return Setting.objects.filter(name__in=self.available_names)
+
+    def list(self, request, *args, **kwargs):
+        values = settings_cache.all()
+        return Response([
+            {'name': name, 'value': values[name]} for name in self.available_names if name in values
+        ])
 
     def http_method_not_allowed(self, request, *args, **kwargs):
         if request.method != 'GET':
@@ -53,25 +87,36 @@ class SettingViewSet(viewsets.ModelViewSet):
         return super().http_method_not_allowed(request, *args, **kwargs)
 
 
-class ConversationViewSet(viewsets.ModelViewSet):
+def delete_user_rows(request, delete, rows):
+    """run delete for the user, in the background when rows is large"""
+    if is_large(rows):
+        job = start_job('delete', request.user, delete_job, delete, request.user)
+        return Response(job.state, status=status.HTTP_202_ACCEPTED)
+    delete(request.user)
+    return Response(status=204)
+
+
+class ConversationViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = ConversationSerializer
     # authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    list_fields = ('id', 'topic', 'created_at')
 
     def get_queryset(self):
         return Conversation.objects.filter(user=self.request.user).order_by('-created_at')
 
     @action(detail=False, methods=['delete'])
     def delete_all(self, request):
-        queryset = self.filter_queryset(self.get_queryset())
-        queryset.delete()
-        return Response(status=204)
+        return delete_user_rows(request, delete_conversations, Message.objects.filter(conversation__user=request.user))
 
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     # authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    list_fields = ('id', 'message', 'is_bot', 'is_truncated', 'message_type', 'embedding_message_doc', 'created_at')
     # queryset = Message.objects.all()
 
     def get_queryset(self):
@@ -103,9 +148,7 @@ class PromptViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['delete'])
     def delete_all(self, request):
-        queryset = self.filter_queryset(self.get_queryset())
-        queryset.delete()
-        return Response(status=204)
+        return delete_user_rows(request, delete_prompts, Prompt.objects.filter(user=request.user))
 
 
 class EmbeddingDocumentViewSet(viewsets.ModelViewSet):
@@ -126,7 +169,7 @@ class EmbeddingDocumentViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
     def get_embedding(self):
-        """get the faiss_store of uploaded file"""
+        """embed the uploaded file and return the store_path of its faiss store"""
 
         openai_api_key = self.request.data.get('openaiApiKey', None)
         api_key = None
@@ -146,8 +189,7 @@ class EmbeddingDocumentViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-        my_openai = get_openai(openai_api_key)
-        llm_openai_env(my_openai.api_base, my_openai.api_key)
+        openai_client = get_openai(openai_api_key)
 
         # Get the uploaded file from the request
         file_data = self.request.data.get('file')
@@ -167,33 +209,37 @@ class EmbeddingDocumentViewSet(viewsets.ModelViewSet):
             with open(dump_name, mode) as f:
                 f.write(file_bytes)
 
-            faiss_store = get_embedding_document(dump_name, file_mime)
+            try:
+                db = get_embedding_document(dump_name, file_mime, openai_client.embeddings)
+            finally:
+                api_key_scheduler.release(api_key)
 
-        return faiss_store
+        return save_faiss(db, self.request.user.id)
 
     def perform_create(self, serializer):
-        faiss_store = self.get_embedding()
+        store_path = self.get_embedding()
 
         # Set the `value` field on the serializer instance
-        serializer.validated_data['faiss_store'] = faiss_store
+        serializer.validated_data['store_path'] = store_path
 
         # Call the serializer's `save` method to create the new instance
         serializer.save()
 
     def perform_update(self, serializer):
-        faiss_store = self.get_embedding()
+        old_store_path = serializer.instance.store_path
+        store_path = self.get_embedding()
 
         # Set the `value` field on the serializer instance
-        serializer.validated_data['faiss_store'] = faiss_store
+        serializer.validated_data['store_path'] = store_path
+        serializer.validated_data['faiss_store'] = None
 
         # Call the serializer's `save` method to update the instance
         serializer.save()
+        delete_faiss(old_store_path)
 
     @action(detail=False, methods=['delete'])
     def delete_all(self, request):
-        queryset = self.filter_queryset(self.get_queryset())
-        queryset.delete()
-        return Response(status=204)
+        return delete_user_rows(request, delete_documents, Message.objects.filter(embedding_message_doc__user=request.user))
 
 
 MODELS = {
@@ -224,72 +270,36 @@ MODELS = {
 }
 
 
-def sse_pack(event, data):
-    # Format data as an SSE message
-    packet = "event: %s\n" % event
-    packet += "data: %s\n" % json.dumps(data)
-    packet += "\n"
-    return packet
-
-
 @api_view(['POST'])
 # @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
 def gen_title(request):
+    """return the title of a conversation, generated in the background if it has none yet"""
     conversation_id = request.data.get('conversationId')
     prompt = request.data.get('prompt')
-    conversation_obj = Conversation.objects.get(id=conversation_id)
-    message = Message.objects.filter(conversation_id=conversation_id).order_by('created_at').first()
     openai_api_key = request.data.get('openaiApiKey')
-    api_key = None
-
-    if openai_api_key is None:
-        openai_api_key = get_api_key_from_setting()
-
-    if openai_api_key is None:
-        api_key = get_api_key()
-        if api_key:
-            openai_api_key = api_key.key
-        else:
-            return Response(
-                {
-                    'error': 'There is no available API key'
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-    if prompt is None:
-        prompt = 'Generate a short title for the following content, no more than 10 words. \n\nContent: '
-
-    messages = [
-        {"role": "user", "content": prompt + message.message},
-    ]
+    conversation_obj = Conversation.objects.filter(id=conversation_id, user=request.user).first()
+    if conversation_obj is None:
+        return Response(status=status.HTTP_404_NOT_FOUND)
+    title = conversation_obj.topic or cached_title(conversation_obj.id)
+    if title:
+        return Response({
+            'title': title
+        })
 
-    my_openai = get_openai(openai_api_key)
+    message = Message.objects.filter(conversation_id=conversation_id).order_by('created_at').first()
+    if message is None:
+        return Response({
+            'title': UNTITLED
+        })
+    future = title_queue.enqueue(conversation_obj.id, request.user, message.message, prompt, openai_api_key)
     try:
-        openai_response = my_openai.ChatCompletion.create(
-            model='gpt-3.5-turbo-0301',
-            messages=messages,
-            max_tokens=256,
-            temperature=0.5,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
-        completion_text = openai_response['choices'][0]['message']['content']
-        title = completion_text.strip().replace('"', '')
-
-        # increment the token count
-        increase_token_usage(request.user, openai_response['usage']['total_tokens'], api_key)
-    except Exception as e:
-        print(e)
-        title = 'Untitled Conversation'
-    # update the conversation title
-    conversation_obj.topic = title
-    conversation_obj.save()
+        title = future.result(timeout=TITLE_WAIT_SECONDS)
+    except FutureTimeoutError:
+        title = None
 
     return Response({
-        'title': title
+        'title': title or UNTITLED
     })
 
 
@@ -297,84 +307,149 @@ def gen_title(request):
 # @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
 def upload_conversations(request):
-    """allow user to import a list of conversations"""
+    """allow user to import a list of conversations
+
+    Small uploads are imported at once and answered with the new conversation
+    ids. Larger ones are spooled to disk and imported by a background job,
+    answered with 202 and the job to poll. Uploads over IMPORT_MAX_BYTES are
+    refused with 413.
+    """
     user=request.user
     import_err_msg = 'bad_import'
-    conversation_ids = []
+    ndjson = request.content_type == NDJSON
     try:
-        imports = request.data.get('imports')
-        # verify
-        conversations = []
-        for conversation in imports:
-            topic = conversation.get('conversation_topic', None)
-            messages = []
-            for message in conversation.get('messages'):
-                msg = {}
-                msg['role'] = message['role']
-                msg['content'] = message['content']
-                messages.append(msg)
-            if len(messages) > 0:
-                conversations.append({
-                    'topic': topic,
-                    'messages': messages,
-                })
-        # dump
-        for conversation in conversations:
-            topic = conversation['topic']
-            messages = conversation['messages']
-            cobj = Conversation(
-                topic=topic if topic else '',
-                user=user,
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+
+    too_large = Response(
+        {'error': 'import_too_large'},
+        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    )
+    if content_length > settings.IMPORT_MAX_BYTES:
+        return too_large
+
+    if content_length and content_length <= IMPORT_INLINE_BYTES:
+        try:
+            with transaction.atomic():
+                conversation_ids = import_conversations(user, io.BytesIO(request.body), ndjson=ndjson)
+        except Exception as e:
+            logger.debug(e)
+            return Response(
+                {'error': import_err_msg},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            cobj.save()
-            conversation_ids.append(cobj.id)
-            for idx, msg in enumerate(messages):
-                try:
-                    Message._meta.get_field('user')
-                    mobj = Message(
-                        user=user,
-                        conversation=cobj,
-                        message=msg['content'],
-                        is_bot=msg['role'] != 'user',
-                        messages=messages[:idx + 1],
-                    )
-                except:
-                    mobj = Message(
-                        conversation=cobj,
-                        message=msg['content'],
-                        is_bot=msg['role'] != 'user',
-                        messages=messages[:idx + 1],
-                    )
-                mobj.save()
-    except Exception as e:
-        logger.debug(e)
+        # return a list of new conversation id
+        return Response(conversation_ids)
+
+    stream = request.stream
+    if stream is None:
         return Response(
             {'error': import_err_msg},
             status=status.HTTP_400_BAD_REQUEST
         )
-    
-    # return a list of new conversation id
-    return Response(conversation_ids)
+    with tempfile.NamedTemporaryFile(prefix='import-', suffix='.json', delete=False) as spool:
+        spooled = 0
+        while chunk := stream.read(UPLOAD_CHUNK_BYTES):
+            spooled += len(chunk)
+            if spooled > settings.IMPORT_MAX_BYTES:  # no or a wrong Content-Length
+                break
+            spool.write(chunk)
+    if spooled > settings.IMPORT_MAX_BYTES:
+        os.remove(spool.name)
+        return too_large
+    job = start_job('import', user, import_job, user, spool.name, ndjson)
+    return Response(job.state, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_conversations(request):
+    """download all the conversations of the user as NDJSON, in the shape upload_conversations accepts"""
+    lines = export_lines(request.user)
+    next_chunk = sync_to_async(lambda: next(lines, None))
+
+    async def stream():
+        # the cursor stays on the thread of sync_to_async, chunks are sent as they are read
+        while (chunk := await next_chunk()) is not None:
+            yield chunk
+
+    response = StreamingHttpResponse(stream(), content_type=NDJSON)
+    response['Content-Disposition'] = 'attachment; filename="conversations.ndjson"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
-@api_view(['POST'])
-# @authentication_classes([JWTAuthentication])
+@api_view(['GET'])
 @permission_classes([IsAuthenticated])
-def conversation(request):
-    model_name = request.data.get('name')
-    message_object_list = request.data.get('message')
-    conversation_id = request.data.get('conversationId')
-    request_max_response_tokens = request.data.get('max_tokens')
-    system_content = request.data.get('system_content')
+def job_status(request, job_id):
+    """progress of a background job of the user"""
+    state = get_job(job_id, request.user)
+    if state is None:
+        return Response(status=status.HTTP_404_NOT_FOUND)
+    return Response(state)
+
+
+def authenticate_request(request):
+    """run the DRF authenticators on a plain django request, return the user or None"""
+    drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+    try:
+        user = drf_request.user
+    except exceptions.APIException:
+        return None
+    return user if user.is_authenticated else None
+
+
+async def conversation(request):
+    """stream the answer of a conversation as server-sent events
+
+    This is a native async view: under ASGI an open stream only holds a
+    coroutine while it waits on the LLM, not a worker thread.
+
+    The Server-Timing header is sent before the answer, so it only holds the
+    setup phases. The phases of the answer (upstream_ttft, ttft, generation,
+    persist) are sent in the serverTiming field of the done event.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    user = await sync_to_async(authenticate_request)(request)
+    if user is None:
+        return JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:  # a reconnect, the answer is being generated already
+        return await resume_conversation(request, user, last_event_id)
+
+    timer = RequestTimer('conversation')
+
+    try:
+        data = json.loads(request.body)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    model_name = data.get('name')
+    message_object_list = data.get('message')
+    conversation_id = data.get('conversationId')
+    request_max_response_tokens = data.get('max_tokens')
+    system_content = data.get('system_content')
     if not system_content:
         system_content = "You are a helpful assistant."
-    temperature = request.data.get('temperature', 0.7)
-    top_p = request.data.get('top_p', 1)
-    frequency_penalty = request.data.get('frequency_penalty', 0)
-    presence_penalty = request.data.get('presence_penalty', 0)
-    web_search_params = request.data.get('web_search')
-    openai_api_key = request.data.get('openaiApiKey')
-    frugal_mode = request.data.get('frugalMode', False)
+    temperature = data.get('temperature', 0.7)
+    top_p = data.get('top_p', 1)
+    frequency_penalty = data.get('frequency_penalty', 0)
+    presence_penalty = data.get('presence_penalty', 0)
+    web_search_params = data.get('web_search')
+    openai_api_key = data.get('openaiApiKey')
+    user_api_key = openai_api_key
+    frugal_mode = data.get('frugalMode', False)
+    title_prompt = data.get('titlePrompt')
+    title_future = None
+    # set when no client reads the answer anymore
+    abandoned = asyncio.Event() if stream_buffer is not None else client_disconnected(request)
 
     message_object = message_object_list[-1]
     message_type = message_object.get('message_type', 0)
@@ -387,49 +462,149 @@ def conversation(request):
 
     logger.debug('conversation_id = %s message_objects = %s', conversation_id, message_object_list)
 
-    api_key = None
+    try:
+        model = get_current_model(model_name, request_max_response_tokens)
+    except KeyError:
+        return JsonResponse({'error': f'Unknown model {model_name}'}, status=status.HTTP_400_BAD_REQUEST)
 
-    if openai_api_key is None:
-        openai_api_key = get_api_key_from_setting()
+    api_key = None
 
-    if openai_api_key is None:
-        api_key = get_api_key()
-        if api_key:
-            openai_api_key = api_key.key
-        else:
-            return Response(
-                {
-                    'error': 'There is no available API key'
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
+    # a key taken from the scheduler must be released on every path from here
+    with timer.phase('api_key'):
+        if openai_api_key is None:
+            openai_api_key = await sync_to_async(get_api_key_from_setting)()
 
-    my_openai = get_openai(openai_api_key)
-    llm_openai_env(my_openai.api_base, my_openai.api_key)
+        if openai_api_key is None:
+            api_key = await sync_to_async(get_api_key)()
+            if api_key:
+                openai_api_key = api_key.key
+            else:
+                return JsonResponse(
+                    {
+                        'error': 'There is no available API key'
+                    },
+                    status=status.HTTP_400_BAD_REQUEST
+                )
 
-    model = get_current_model(model_name, request_max_response_tokens)
-    llm_openai_model(model)
+    my_openai = use_openai_client(get_openai(openai_api_key))
+    use_openai_model(model)
 
     try:
-        messages = build_messages(model, request.user, conversation_id, message_object_list, web_search_params, system_content, frugal_mode, tool, message_type)
+        with timer.phase('build_messages'):
+            messages = await sync_to_async(build_messages)(model, user, conversation_id, message_object_list, web_search_params, system_content, frugal_mode, tool, message_type)
         # message_object_list will be changed in build_messages
 
         new_doc_id = messages.get('doc_id', None)
         new_doc_title = messages.get('doc_title', None)
         logger.debug('messages: %s\n%s\n%s', messages, new_doc_id, new_doc_title)
     except Exception as e:
-        print(e)
-        return Response(
+        logger.error('build messages error %s', e)
+        api_key_scheduler.release(api_key)
+        return JsonResponse(
             {
-                'error': e
+                'error': str(e)
             },
             status=status.HTTP_400_BAD_REQUEST
         )
 
-    def stream_content():
+    def persist_turn(completion_text, bot_message_type, ai_message_token, truncated=False):
+        """save the turn once the answer is complete, off the time-to-first-token path
+
+        An answer cut short by a client disconnect is saved as far as it got, flagged truncated.
+        """
+        user_messages = [
+            make_message(
+                user=user,
+                message=m['content'],
+                message_type=m.get('message_type', 0),
+                embedding_doc_id=m.get('embedding_message_doc', None),
+                messages=messages['snapshot'],
+                tokens=num_tokens_from_text(m['content'], model['name']),
+            )
+            for m in message_object_list
+        ]
+        bot_message = make_message(
+            user=user,
+            message=completion_text,
+            message_type=bot_message_type,
+            is_bot=True,
+            tokens=ai_message_token,
+            is_truncated=truncated,
+        )
+        usage_tokens = messages['tokens'] + ai_message_token
+        if messages['renew']:
+            usage_writer.record(
+                user, model['name'],
+                prompt_tokens=messages['tokens'],
+                completion_tokens=ai_message_token,
+                latency_ms=(time.perf_counter() - timer.started) * 1000,
+                api_key=api_key,
+            )
+        return save_messages(user, conversation_id, user_messages + [bot_message], usage_tokens, api_key, system_content)
+
+    def first_token(upstream_started):
+        now = time.perf_counter()
+        timer.record('upstream_ttft', now - upstream_started)
+        timer.since_start('ttft')
+        return now
+
+    async def done(completion_text, bot_message_type, ai_message_token, truncated=False):
+        nonlocal title_future
+        timer.tokens = ai_message_token
+        try:
+            with timer.phase('persist'):
+                saved_conversation_id, saved_messages = await sync_to_async(persist_turn)(
+                    completion_text, bot_message_type, ai_message_token, truncated,
+                )
+        except Exception as e:
+            logger.error('persist messages error %s', e)
+            return sse_pack('error', {
+                'error': str(e)
+            })
+        if not conversation_id and bot_message_type == Message.plain_message_type:
+            # the first answer of a new conversation, name it meanwhile
+            title_future = title_queue.enqueue(
+                saved_conversation_id, user, message_object_list[0]['content'], title_prompt, user_api_key,
+            )
+        return sse_pack('done', {
+            'userMessageId': saved_messages[-2].id,
+            'messageId': saved_messages[-1].id,
+            'conversationId': saved_conversation_id,
+            'newDocId': new_doc_id,
+            'serverTiming': timer.server_timing(),
+        })
+
+    async def context_added():
+        """acknowledge a context message, once the tool job attaching it is done"""
+        nonlocal new_doc_id, new_doc_title
+        job = messages.get('job')
+        if job is not None:
+            try:
+                with timer.phase('tool_job'):
+                    async for event in job.progress():
+                        yield sse_pack('progress', event)
+                    outcome = job.result()
+            except Exception as e:
+                logger.error('tool job error %s', e)
+                yield sse_pack('error', {
+                    'error': str(e)
+                })
+                return
+            new_doc_id = outcome['embedding_doc_id']
+            new_doc_title = outcome['doc_title']
+            message_object_list[-1]['embedding_message_doc'] = new_doc_id
+        if new_doc_title:
+            completion_text = f'{new_doc_title} added.'
+        else:
+            completion_text = 'Context added.'
+        yield sse_pack('message', {'content': completion_text})
+        yield await done(completion_text, Message.temp_message_type, 0)
+
+    async def stream_content():
+        upstream_started = time.perf_counter()
         try:
             if messages['renew']:
-                openai_response = my_openai.ChatCompletion.create(
+                openai_response = await my_openai.ChatCompletion.acreate(
                     model=model['name'],
                     messages=messages['messages'],
                     max_tokens=model['max_response_tokens'],
@@ -440,215 +615,295 @@ def conversation(request):
                     stream=True,
                 )
         except Exception as e:
+            if isinstance(e, openai.error.RateLimitError):
+                api_key_scheduler.cooldown(api_key)
             yield sse_pack('error', {
                 'error': str(e)
             })
-            print('openai error', e)
+            logger.error('openai error %s', e)
             return
 
-        if conversation_id:
-            # get the conversation
-            conversation_obj = Conversation.objects.get(id=conversation_id)
-        else:
-            # create a new conversation
-            conversation_obj = Conversation(user=request.user)
-            conversation_obj.save()
-
-        # insert new messages
-        try:
-            for m in message_object_list:
-                message_obj = create_message(
-                    user=request.user,
-                    conversation_id=conversation_obj.id,
-                    message=m['content'],
-                    message_type=m.get('message_type', 0),
-                    embedding_doc_id=m.get('embedding_message_doc', 0),
-                    messages=messages['messages'],
-                    tokens=messages['tokens'],
-                    api_key=api_key
-                )
-                yield sse_pack('userMessageId', {
-                    'userMessageId': message_obj.id,
-                })
-        except Exception as e:
-            return Response(
-                {
-                    'error': e
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            ) 
-
-        collected_events = []
         completion_text = ''
+        finished = False
         if messages['renew']:  # return LLM answer
-            # iterate through the stream of events
-            for event in openai_response:
-                collected_events.append(event)  # save the event response
-                # print(event)
-                if event['choices'][0]['finish_reason'] is not None:
-                    break
-                if 'content' in event['choices'][0]['delta']:
-                    event_text = event['choices'][0]['delta']['content']
-                    completion_text += event_text  # append the text
-                    yield sse_pack('message', {'content': event_text})
-            bot_message_type = Message.plain_message_type
-            ai_message_token = num_tokens_from_text(completion_text, model['name'])
-        else:  # wait for process context
-            if new_doc_title:
-                completion_text = f'{new_doc_title} added.'
-            else:
-                completion_text = 'Context added.'
-            yield sse_pack('message', {'content': completion_text})
-            bot_message_type = Message.temp_message_type
-            ai_message_token = 0
-
-        ai_message_obj = create_message(
-            user=request.user,
-            conversation_id=conversation_obj.id,
-            message=completion_text,
-            message_type=bot_message_type,
-            is_bot=True,
-            tokens=ai_message_token,
-            api_key=api_key
-        )
-        yield sse_pack('done', {
-            'messageId': ai_message_obj.id,
-            'conversationId': conversation_obj.id,
-            'newDocId': new_doc_id,
-        })
+            generation_started = None
+
+            async def deltas():
+                nonlocal completion_text, generation_started, finished
+                try:
+                    # iterate through the stream of events
+                    async for event in openai_response:
+                        if event['choices'][0]['finish_reason'] is not None:
+                            break
+                        if 'content' in event['choices'][0]['delta']:
+                            event_text = event['choices'][0]['delta']['content']
+                            if generation_started is None:
+                                generation_started = first_token(upstream_started)
+                            completion_text += event_text  # append the text
+                            yield event_text
+                    finished = True
+                finally:
+                    await openai_response.aclose()  # stop the upstream generation
 
-    def stream_langchain():
-        if messages['renew']:  # if the new user message is sending to AI
             try:
-                # get a results generator
-                gen = langchain_doc_chat(messages)
+                async for text in coalesce(deltas(), disconnected=abandoned):
+                    yield sse_pack('message', {'content': text})
             except Exception as e:
+                # the upstream stream failed midway, the partial answer is not saved
+                if isinstance(e, openai.error.RateLimitError):
+                    api_key_scheduler.cooldown(api_key)
                 yield sse_pack('error', {
                     'error': str(e)
                 })
-                logger.debug('langchain error %s', e)
-        # create conversation
-        if conversation_id:
-            # get the conversation
-            conversation_obj = Conversation.objects.get(id=conversation_id)
-        else:
-            # create a new conversation
-            conversation_obj = Conversation(user=request.user)
-            conversation_obj.save()
-        # insert new user messages
-        try:
-            for m in message_object_list:
-                message_obj = create_message(
-                    user=request.user,
-                    conversation_id=conversation_obj.id,
-                    message=m['content'],
-                    message_type=m.get('message_type', 0),
-                    embedding_doc_id=m.get('embedding_message_doc', 0),
-                    messages=messages['messages'],
-                    tokens=messages['tokens'],
-                    api_key=api_key
-                )
-                yield sse_pack('userMessageId', {
-                    'userMessageId': message_obj.id,
-                })
-        except Exception as e:
-            return Response({'error': e}, status=status.HTTP_400_BAD_REQUEST)
+                logger.error('openai error %s', e)
+                return
+            if generation_started is not None:
+                timer.record('generation', time.perf_counter() - generation_started)
+            bot_message_type = Message.plain_message_type
+            ai_message_token = num_tokens_from_text(completion_text, model['name'])
+        else:  # wait for process context
+            async for packet in context_added():
+                yield packet
+            return
+
+        if not finished:
+            logger.info('answer abandoned by the client, truncated after %d characters', len(completion_text))
+        yield await done(completion_text, bot_message_type, ai_message_token, not finished)
 
+    async def stream_langchain():
+        upstream_started = time.perf_counter()
         completion_text = ''
+        finished = False
         if messages['renew']:  # if AI has read and replied this message
-            for event in gen:
-                if event['status'] == 'done':
-                    pass
-                else:
-                    text = event['content']
-                    if text:
-                        completion_text += str(text)
-                        yield sse_pack('message', {'content': str(text)})
+            # a results generator, which raises while it is iterated
+            gen = langchain_doc_chat(messages)
+            generation_started = None
+
+            async def deltas():
+                nonlocal completion_text, generation_started, finished
+                try:
+                    async for event in gen:
+                        if event['status'] == 'done':
+                            finished = True
+                        else:
+                            text = event['content']
+                            if text:
+                                if generation_started is None:
+                                    generation_started = first_token(upstream_started)
+                                completion_text += str(text)
+                                yield str(text)
+                finally:
+                    await gen.aclose()  # cancels the chain task when it is still running
+
+            try:
+                async for text in coalesce(deltas(), disconnected=abandoned):
+                    yield sse_pack('message', {'content': text})
+            except Exception as e:
+                yield sse_pack('error', {
+                    'error': str(e)
+                })
+                logger.error('langchain error %s', e)
+                return
+            if generation_started is not None:
+                timer.record('generation', time.perf_counter() - generation_started)
             bot_message_type = Message.plain_message_type
         else:   # else, this message was not produced by AI
-            if new_doc_title:
-                completion_text = f'{new_doc_title} added.'
-            else:
-                completion_text = 'Context added.'
-            yield sse_pack('message', {'content': completion_text})
-            bot_message_type = Message.temp_message_type
+            async for packet in context_added():
+                yield packet
+            return
 
         logger.debug('return message is: %s', completion_text)
+        if not finished:
+            logger.info('answer abandoned by the client, truncated after %d characters', len(completion_text))
         ai_message_token = num_tokens_from_text(completion_text, model['name'])
-        ai_message_obj = create_message(
-            user=request.user,
-            conversation_id=conversation_obj.id,
-            message=completion_text,
-            message_type=bot_message_type,
-            is_bot=True,
-            tokens=ai_message_token,
-            api_key=api_key
-        )
-        yield sse_pack('done', {
-            'messageId': ai_message_obj.id,
-            'conversationId': conversation_obj.id,
-            'newDocId': new_doc_id,
-        })
+        yield await done(completion_text, bot_message_type, ai_message_token, not finished)
+
+    async def release_api_key(stream):
+        try:
+            async for packet in stream:
+                yield packet
+        finally:
+            api_key_scheduler.release(api_key)
+            timer.finish()
+            try:
+                await sync_to_async(flush_stats)()
+            except Exception as e:
+                logger.error('cannot flush request stats %s', e)
+        if title_future is not None and not abandoned.is_set():
+            try:
+                title = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(title_future)), TITLE_WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                title = None
+            if title:
+                yield sse_pack('title', {'title': title})
 
     if messages.get('faiss_store', None) and not web_search_params:
         # this conversation has contexts, and this is not a web search
-        response = StreamingHttpResponse(
-            stream_langchain(),  # response generator
-            content_type='text/event-stream'
-        )
+        stream = stream_langchain()
     else:
-        response = StreamingHttpResponse(
-            stream_content(),
-            content_type='text/event-stream'
-        )
+        stream = stream_content()
+
+    if stream_buffer is not None:
+        # the answer is generated apart from this request, which reads it back from
+        # the buffer like a client resuming it with Last-Event-ID would
+        generation_id = uuid.uuid4().hex
+        key = stream_key(user.id, generation_id)
+        await publish(key, release_api_key(stream), abandoned)
+        response = event_stream(until_disconnected(replay(key, generation_id), client_disconnected(request)))
+    else:
+        response = event_stream(release_api_key(stream))
+    # only the phases before the first byte, the rest follows in the done event
+    response['Server-Timing'] = timer.server_timing()
+    return response
+
+
+def event_stream(frames):
+    response = StreamingHttpResponse(frames, content_type='text/event-stream')
     response['X-Accel-Buffering'] = 'no'
     response['Cache-Control'] = 'no-cache'
     return response
 
 
+async def resume_conversation(request, user, last_event_id):
+    """stream the frames of an answer after last_event_id, then its live tail"""
+    try:
+        if stream_buffer is None:
+            raise ResumeError(last_event_id)
+        generation_id, after = parse_event_id(last_event_id)
+        key = stream_key(user.id, generation_id)
+        await stream_buffer.check(key, after)
+    except (ValueError, ResumeError):
+        return JsonResponse({'error': 'The answer cannot be resumed anymore.'}, status=status.HTTP_404_NOT_FOUND)
+    logger.debug('resume %s after %d', key, after)
+    return event_stream(until_disconnected(replay(key, generation_id, after), client_disconnected(request)))
+
+
+# the JWT cookie authenticator enforces CSRF itself, like DRF views do
+conversation.csrf_exempt = True
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def documents(request):
     pass
 
 
-def create_message(user, conversation_id, message, is_bot=False, message_type=0, embedding_doc_id=None, messages='', tokens=0, api_key=None):
-    message_obj = Message(
-        conversation_id=conversation_id,
+def flush_stats():
+    """write the buffered request timings and usage records when they are due"""
+    aggregates.flush_due()
+    usage_writer.flush_due()
+
+
+def make_message(user, message, is_bot=False, message_type=0, embedding_doc_id=None, messages='', tokens=0, is_truncated=False):
+    """build an unsaved message with its own token count"""
+    return Message(
         user=user,
         message=message,
         is_bot=is_bot,
         message_type=message_type,
-        embedding_message_doc=EmbeddingDocument.objects.get(pk=embedding_doc_id) if embedding_doc_id else None,
+        embedding_message_doc_id=embedding_doc_id or None,
         messages=messages,
         tokens=tokens,
+        is_truncated=is_truncated,
     )
-    if message_type != Message.temp_message_type:
-        message_obj.save()
 
-    increase_token_usage(user, tokens, api_key)
 
-    return message_obj
+def save_messages(user, conversation_id, message_objs, usage_tokens, api_key=None, system_prompt=None):
+    """save the messages of a turn and bill its token usage in one transaction
+
+    A new conversation is created when conversation_id is empty. Temp messages
+    are not stored. system_prompt is the one referenced by the prompt snapshots.
+    Returns the conversation id and the message objects.
+    """
+    with transaction.atomic():
+        if system_prompt is not None:
+            store_system_prompt(system_prompt)
+        if not conversation_id:
+            conversation_id = Conversation.objects.create(user=user).id
+        stored = [m for m in message_objs if m.message_type != Message.temp_message_type]
+        for message_obj in message_objs:
+            message_obj.conversation_id = conversation_id
+        if connection.features.can_return_rows_from_bulk_insert:
+            Message.objects.bulk_create(stored)
+        else:  # the ids are needed by the client
+            for message_obj in stored:
+                message_obj.save()
+        increase_token_usage(user, usage_tokens, api_key)
+
+    context_doc_ids = [
+        m.embedding_message_doc_id for m in stored
+        if m.embedding_message_doc_id and m.message_type in (Message.arxiv_context_message_type, Message.doc_context_message_type)
+    ]
+    if context_doc_ids:
+        add_conversation_documents(conversation_id, context_doc_ids)
 
+    return conversation_id, message_objs
 
-def increase_token_usage(user, tokens, api_key=None):
-    token_usage, created = TokenUsage.objects.get_or_create(user=user)
-    token_usage.tokens += tokens
-    token_usage.save()
 
-    if api_key:
-        api_key.token_used += tokens
-        api_key.save()
+HISTORY_PAGE_SIZE = 50
+HISTORY_FIELDS = ('id', 'message', 'is_bot', 'message_type', 'embedding_message_doc', 'tokens', 'created_at')
 
 
-def build_messages(model, user, conversation_id, new_messages, web_search_params, system_content, frugal_mode = False, tool = None, message_type=0):
-    if conversation_id:
-        ordered_messages = Message.objects.filter(conversation_id=conversation_id).order_by('created_at')
-        ordered_messages_list = list(ordered_messages)
-    else:
-        ordered_messages_list = []
+def load_history(conversation_id, page_size=HISTORY_PAGE_SIZE):
+    """yield the messages of a conversation newest first, one page at a time
+
+    Pages are fetched with a keyset on (created_at, id), so the caller only pays
+    for the pages it consumes before its token budget is exhausted.
+    """
+    queryset = Message.objects.filter(conversation_id=conversation_id).order_by('-created_at', '-id').values(*HISTORY_FIELDS)
+    last = None
+    while True:
+        page = queryset
+        if last:
+            page = page.filter(
+                Q(created_at__lt=last['created_at']) | Q(created_at=last['created_at'], id__lt=last['id'])
+            )
+        with timed('history_db'):
+            page = list(page[:page_size])
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
 
-    ordered_messages_list += [{
+CONTEXT_MESSAGE_TYPES = (
+    Message.hidden_message_type,
+    Message.arxiv_context_message_type,
+    Message.doc_context_message_type,
+)
+
+augment_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='augment')
+
+
+def message_tokens(message, content, model_name):
+    """prompt tokens of a message, from its stored count when the content is unchanged"""
+    role = "assistant" if message['is_bot'] else "user"
+    with timed('tokenize'):
+        if message.get('tokens') and content == message['message']:
+            return num_tokens_from_stored_message(role, message['tokens'], model_name)
+        return num_tokens_from_message({"role": role, "content": content}, model_name)
+
+
+def augment_message(content, web_search_params, tool):
+    """return the newest message rewritten by the web search or the tool"""
+    try:
+        augmented = content
+        if web_search_params is not None:
+            with timed('web_search'):
+                search_results = web_search(SearchRequest(content, ua=web_search_params['ua']), num_results=5)
+            augmented = compile_prompt(search_results, content, default_prompt=web_search_params['default_prompt'])
+        if tool:  # apply to latest message only
+            func = TOOL_LIST.get(tool['name'], None)
+            if func:
+                with timed('tool'):
+                    augmented = func(content, tool['args'])
+        return augmented
+    finally:
+        connections.close_all()  # this thread is not managed by Django
+
+
+def build_messages(model, user, conversation_id, new_messages, web_search_params, system_content, frugal_mode = False, tool = None, message_type=0):
+    pending_messages = [{
         'is_bot': False,
         'message': msg['content'], 
         'message_type': message_type,
@@ -656,7 +911,27 @@ def build_messages(model, user, conversation_id, new_messages, web_search_params
     } for msg in new_messages]
 
     if frugal_mode:
-        ordered_messages_list = ordered_messages_list[-1:]
+        pending_messages = pending_messages[-1:]
+
+    if tool and tool['name'] == 'arxiv':
+        if not tool.get('args', None):
+            tool['args'] = {}
+        tool['args']['conversation_id'] = conversation_id
+        tool['args']['user'] = user
+        tool['args']['openai_client'] = get_current_openai_client()
+
+    # the web search or tool runs on the newest message while the history is loaded
+    augmented = None
+    if pending_messages and (web_search_params is not None or tool):
+        augmented = augment_executor.submit(
+            contextvars.copy_context().run,
+            augment_message, pending_messages[-1]['message'], web_search_params, tool,
+        )
+
+    if conversation_id and not frugal_mode:
+        history = load_history(conversation_id)
+    else:
+        history = iter(())
 
     system_messages = [{"role": "system", "content": system_content}]
 
@@ -664,7 +939,30 @@ def build_messages(model, user, conversation_id, new_messages, web_search_params
 
     max_token_count = model['max_prompt_tokens']
 
+    # newest first: the older new messages, then the stored history, with their
+    # tokens counted until they alone fill the budget
+    prefetched = []
+    budget = max_token_count - current_token_count
+    for message in itertools.chain(reversed(pending_messages[:-1]), history):
+        if budget <= 0:
+            break
+        tokens = None
+        if message['message_type'] not in CONTEXT_MESSAGE_TYPES:
+            tokens = message_tokens(message, message['message'], model['name'])
+            budget -= tokens
+        prefetched.append((message, tokens))
+
+    ordered_messages = prefetched
+    if pending_messages:
+        ordered_messages = [(pending_messages[-1], None)] + prefetched
+
+    content = None
+    if augmented is not None:
+        with timed('augment_wait'):
+            content = augmented.result()
+
     messages = []
+    message_ids = []  # the stored message behind each prompt message, None for new ones
 
     result = {
         'renew': True,
@@ -674,38 +972,20 @@ def build_messages(model, user, conversation_id, new_messages, web_search_params
         'doc_id': None,  # new doc id
     }
 
-    faiss_store = None
+    doc_ids = []
 
     logger.debug('new message is: %s', new_messages)
-    logger.debug('messages are: %s', ordered_messages_list)
     first_msg = True
 
-    while current_token_count < max_token_count and len(ordered_messages_list) > 0:
-        message = ordered_messages_list.pop()
-        if isinstance(message, Message):
-            message = model_to_dict(message)
+    for message, message_token_count in ordered_messages:
+        if current_token_count >= max_token_count:
+            break
         role = "assistant" if message['is_bot'] else "user"
         message_content = message['message']
         message_type = message['message_type']
-        if web_search_params is not None and first_msg:
-            search_results = web_search(SearchRequest(message['message'], ua=web_search_params['ua']), num_results=5)
-            message_content = compile_prompt(search_results, message['message'], default_prompt=web_search_params['default_prompt'])
-        if tool and first_msg:  # apply to latest message only
-            tool_name = tool['name']
-            func = TOOL_LIST.get(tool_name, None)
-            if tool_name == 'arxiv':
-                if not tool.get('args', None):
-                    tool['args'] = {}
-                args = tool['args']
-                args['conversation_id'] = conversation_id
-                args['user'] = user
-            if func:
-                message_content = func(message['message'], tool['args'])
-        if message_type in [
-            Message.hidden_message_type,
-            Message.arxiv_context_message_type,
-            Message.doc_context_message_type,
-        ]:
+        if first_msg and content is not None:
+            message_content = content
+        if message_type in CONTEXT_MESSAGE_TYPES:
             # these messages only attached context to the conversation
             # they should not be sent to the LLM
             if first_msg:  # if the new message is a contextual message
@@ -713,56 +993,43 @@ def build_messages(model, user, conversation_id, new_messages, web_search_params
             if message_type == Message.doc_context_message_type:
                 doc_id = message["embedding_message_doc"]
                 logger.debug('get a document %s', message_content)
-                if doc_id:
+                if doc_id and doc_id not in doc_ids:
                     logger.debug('get the document id %s', doc_id)
-                    doc_obj = EmbeddingDocument.objects.get(id=doc_id)
-                    if doc_obj:
-                        logger.debug('get the document obj %s %s', doc_id, doc_obj.title)
-                        vector_store = unpick_faiss(doc_obj.faiss_store)
-                        if faiss_store:
-                            faiss_store.merge_from(vector_store)
-                        else:
-                            faiss_store = vector_store
-                        logger.debug('document obj %s %s loaded', doc_id, doc_obj.title)
+                    doc_ids.append(doc_id)
             elif message_type == Message.arxiv_context_message_type:
                 if first_msg:
-                    doc_id = tool['args'].get('embedding_doc_id', None)
-                    doc_title = tool['args'].get('doc_title', None)
+                    # the paper is embedded in the background, the stream waits for the job
                     new_messages[-1]['content'] = message_content
-                    new_messages[-1]['embedding_message_doc'] = doc_id
-                    result['doc_id'] = doc_id
-                    result['doc_title'] = doc_title
+                    result['job'] = tool['args']['job']
                 else:
                     doc_id = message['embedding_message_doc']
-                if doc_id:
-                    message['embedding_message_doc'] = doc_id
-                    logger.debug('get the arxiv document id %s', doc_id)
-                    doc_obj = EmbeddingDocument.objects.get(id=doc_id)
-                    if doc_obj:
-                        logger.debug('get the document obj %s %s', doc_id, doc_obj.title)
-                        vector_store = unpick_faiss(doc_obj.faiss_store)
-                        if faiss_store:
-                            faiss_store.merge_from(vector_store)
-                        else:
-                            faiss_store = vector_store
-                        logger.debug('document obj %s %s loaded', doc_id, doc_obj.title)
-                else:
-                    raise RuntimeError('ArXiv document failed to download or embed')
+                    if doc_id:
+                        logger.debug('get the arxiv document id %s', doc_id)
+                        if doc_id not in doc_ids:
+                            doc_ids.append(doc_id)
+                    else:
+                        raise RuntimeError('ArXiv document failed to download or embed')
         else:
             new_message = {"role": role, "content": message_content}
-            new_token_count = num_tokens_from_messages(system_messages + messages + [new_message], model['name'])
+            if message_token_count is None:
+                message_token_count = message_tokens(message, message_content, model['name'])
+            new_token_count = current_token_count + message_token_count
             if new_token_count > max_token_count:
                 if len(messages) > 0:
                     break
                 raise ValueError(
                     f"Prompt is too long. Max token count is {max_token_count}, but prompt is {new_token_count} tokens long.")
             messages.insert(0, new_message)
+            message_ids.insert(0, message.get('id'))
             current_token_count = new_token_count
         first_msg = False
 
     result['messages'] = system_messages + messages
+    result['snapshot'] = prompt_snapshot(result['messages'], message_ids)
     result['tokens'] = current_token_count
-    result['faiss_store'] = faiss_store
+    if doc_ids and conversation_id and result['renew']:
+        with timed('faiss_load'):
+            result['faiss_store'] = get_conversation_store(conversation_id, doc_ids)
 
     return result
 
@@ -770,7 +1037,7 @@ def build_messages(model, user, conversation_id, new_messages, web_search_params
 def get_current_model(model_name, request_max_response_tokens):
     if model_name is None:
         model_name ="gpt-3.5-turbo"
-    model = MODELS[model_name]
+    model = dict(MODELS[model_name])  # changed per request, MODELS is shared
     if request_max_response_tokens is not None:
         model['max_response_tokens'] = int(request_max_response_tokens)
         model['max_prompt_tokens'] = model['max_tokens'] - model['max_response_tokens']
@@ -778,89 +1045,81 @@ def get_current_model(model_name, request_max_response_tokens):
 
 
 def get_api_key_from_setting():
-    row = Setting.objects.filter(name='openai_api_key').first()
-    if row and row.value != '':
-        return row.value
-    return None
+    return settings_cache.get('openai_api_key') or None
 
 
 def get_api_key():
-    return ApiKey.objects.filter(is_enabled=True).order_by('token_used').first()
+    """pick an enabled key, it must be given back with api_key_scheduler.release"""
+    return api_key_scheduler.acquire()
+
+
+# every supported chat model is priced per message as
+# tokens_per_message + content tokens (+ tokens_per_name if a name is set)
+TOKENS_PER_MESSAGE = {
+    'gpt-3.5-turbo': (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+    'gpt-3.5-turbo-0613': (4, -1),
+    'gpt-3.5-turbo-16k': (4, -1),
+    'gpt-3.5-turbo-16k-0613': (4, -1),
+    'gpt-4': (3, 1),
+    'gpt-4-0613': (3, 1),
+    'gpt-4-32k': (4, -1),
+    'gpt-4-32k-0613': (4, -1),
+}
 
+_token_encodings = {}
 
-def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-
-    if model == "gpt-3.5-turbo":
-        print("Warning: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_text(text, model="gpt-3.5-turbo-0613")
-    elif model == "gpt-3.5-turbo-16k":
-        print("Warning: gpt-3.5-turbo-16k may change over time. Returning num tokens assuming gpt-3.5-turbo-16k-0613.")
-        return num_tokens_from_text(text, model="gpt-3.5-turbo-16k-0613")
-    elif model == "gpt-4":
-        print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-        return num_tokens_from_text(text, model="gpt-4-0613")
-    elif model == "gpt-4-32k":
-        print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-        return num_tokens_from_text(text, model="gpt-4-32k-0613")
-
-    if model not in ["gpt-3.5-turbo-0613", "gpt-4-0613", "gpt-3.5-turbo-16k-0613", "gpt-4-32k-0613"]:
+
+def get_token_encoding(model):
+    """return the tiktoken encoding of a model, loaded once per process"""
+    encoding = _token_encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            logger.warning('model %s not found, using cl100k_base encoding', model)
+            encoding = tiktoken.get_encoding('cl100k_base')
+        _token_encodings[model] = encoding
+    return encoding
+
+
+@functools.lru_cache(maxsize=8192)
+def _count_tokens(encoding_name, text):
+    return len(tiktoken.get_encoding(encoding_name).encode(text))
+
+
+def num_tokens_from_text(text, model="gpt-3.5-turbo"):
+    """Returns the number of tokens of a piece of text, memoized by content."""
+    if model not in TOKENS_PER_MESSAGE:
         raise NotImplementedError(f"""num_tokens_from_text() is not implemented for model {model}.""")
+    return _count_tokens(get_token_encoding(model).name, text)
+
+
+def num_tokens_from_message(message, model="gpt-3.5-turbo"):
+    """Returns the number of tokens used by a single message."""
+    if model not in TOKENS_PER_MESSAGE:
+        raise NotImplementedError(f"""num_tokens_from_message() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+    tokens_per_message, tokens_per_name = TOKENS_PER_MESSAGE[model]
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += num_tokens_from_text(value, model)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
 
-    return len(encoding.encode(text))
+def num_tokens_from_stored_message(role, content_tokens, model="gpt-3.5-turbo"):
+    """Returns the number of tokens used by a message whose content tokens are already known."""
+    tokens_per_message, _ = TOKENS_PER_MESSAGE[model]
+    return tokens_per_message + num_tokens_from_text(role, model) + content_tokens
 
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo"):
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        print("Warning: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
-    elif model == "gpt-3.5-turbo-16k":
-        print("Warning: gpt-3.5-turbo-16 may change over time. Returning num tokens assuming gpt-3.5-turbo-16k-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-16k-0613")
-    elif model == "gpt-4":
-        print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
-    elif model == "gpt-4-32k":
-        print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-32k-0613")
-    elif model == "gpt-3.5-turbo-0613":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-3.5-turbo-16k-0613":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4-0613":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-4-32k-0613":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+    num_tokens = sum(num_tokens_from_message(message, model) for message in messages)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
 def get_openai(openai_api_key):
-    openai.api_key = openai_api_key
-    proxy = os.getenv('OPENAI_API_PROXY')
-    if proxy:
-        openai.api_base = proxy
-    return openai
+    """return the pooled OpenAI client of a key"""
+    return get_openai_client(openai_api_key, os.getenv('OPENAI_API_PROXY'))
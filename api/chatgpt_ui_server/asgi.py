@@ -8,9 +8,48 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 """
 
 import os
+import asyncio
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatgpt_ui_server.settings')
 
-application = get_asgi_application()
+
+class DisconnectASGIHandler(ASGIHandler):
+    """an ASGI handler telling streaming responses that the client went away
+
+    Django stops reading the ASGI messages once the request body is read, so a
+    streamed answer would be generated to its end for nobody. This handler keeps
+    listening and sets scope['disconnected'], an asyncio.Event, on http.disconnect.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await super().__call__(scope, receive, send)
+        disconnected = asyncio.Event()
+        listener = None
+
+        async def listen():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        async def receive_body():
+            nonlocal listener
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+            elif not message.get('more_body', False):
+                listener = asyncio.create_task(listen())
+            return message
+
+        try:
+            await super().__call__(dict(scope, disconnected=disconnected), receive_body, send)
+        finally:
+            if listener is not None:
+                listener.cancel()
+
+
+django.setup(set_prefix=False)
+application = DisconnectASGIHandler()
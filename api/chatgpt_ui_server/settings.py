@@ -93,6 +93,8 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'chatgpt_ui_server.wsgi.application'
 
+ASGI_APPLICATION = 'chatgpt_ui_server.asgi.application'
+
 db_config = dj_database_url.config('DB_URL', 'sqlite:///db.sqlite3')
 if db_config.get('ENGINE') == 'django.db.backends.mysql':
     db_config['OPTIONS'] = {'charset': 'utf8mb4'}
@@ -103,6 +105,23 @@ DATABASES = {
     'default': db_config
 }
 
+# Cache shared by the processes when REDIS_URL is set, per process otherwise
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -186,3 +205,35 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
 EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', True) == 'True'
 EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL', False) == 'True'
 DEFAULT_FROM_EMAIL = os.getenv('EMAIL_FROM', 'webmaster@localhost')
+
+# Deserialized FAISS stores kept in memory by each process
+FAISS_CACHE_MAX_BYTES = int(os.getenv('FAISS_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Directory holding the FAISS index and docstore files of embedding documents
+EMBEDDING_STORE_DIR = os.getenv('EMBEDDING_STORE_DIR', os.path.join(BASE_DIR, 'embedding_store'))
+
+# Largest upload of conversations to import, larger ones are answered with 413
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', 100 * 1024 * 1024))
+
+# API key load balancing, see provider/scheduler.py
+API_KEY_REQUESTS_PER_MINUTE = int(os.getenv('API_KEY_REQUESTS_PER_MINUTE', 0))  # of keys without their own limit, 0 is unlimited
+API_KEY_COOLDOWN_SECONDS = int(os.getenv('API_KEY_COOLDOWN_SECONDS', 60))
+API_KEY_REFRESH_SECONDS = int(os.getenv('API_KEY_REFRESH_SECONDS', 30))
+
+# Answer deltas are merged into one SSE frame per SSE_COALESCE_MS, or per
+# SSE_COALESCE_BYTES when they come faster; 0 sends every delta on its own
+SSE_COALESCE_MS = int(os.getenv('SSE_COALESCE_MS', 50))
+SSE_COALESCE_BYTES = int(os.getenv('SSE_COALESCE_BYTES', 1024))
+
+# A client can resume an answer with Last-Event-ID when its frames are buffered
+# where every worker reads them: in Redis when REDIS_URL is set, or in process
+# memory when SERVER_WORKERS is 1. Otherwise answers are streamed without ids.
+# Frames are kept SSE_BUFFER_SECONDS, and a resumable generation stops when no
+# client has read it for SSE_RESUME_SECONDS
+SSE_RESUME = bool(REDIS_URL) or os.getenv('SERVER_WORKERS', '3') == '1'
+SSE_BUFFER_SECONDS = int(os.getenv('SSE_BUFFER_SECONDS', 300))
+SSE_BUFFER_FRAMES = int(os.getenv('SSE_BUFFER_FRAMES', 4096))
+SSE_RESUME_SECONDS = int(os.getenv('SSE_RESUME_SECONDS', 30))
+
+# Bearer token required to scrape /api/metrics/, open when empty
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
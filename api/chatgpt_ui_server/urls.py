@@ -15,13 +15,18 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from chat.views import conversation, gen_title, upload_conversations
+from chat.views import conversation, gen_title, upload_conversations, export_conversations, job_status
+from stats.views import metrics
 
 urlpatterns = [
     path('api/chat/', include('chat.urls')),
     path('api/conversation/', conversation, name='conversation'),
     path('api/upload_conversations/', upload_conversations, name='upload_conversations'),
+    path('api/export_conversations/', export_conversations, name='export_conversations'),
+    path('api/jobs/<str:job_id>/', job_status, name='job_status'),
     path('api/gen_title/', gen_title, name='gen_title'),
     path('api/account/', include('account.urls')),
+    path('api/metrics/', metrics, name='metrics'),
+    path('api/stats/', include('stats.urls')),
     path('admin/', admin.site.urls),
 ]
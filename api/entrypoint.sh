@@ -8,4 +8,4 @@ export WORKERS=${SERVER_WORKERS:-3}
 
 export TIMEOUT=${WORKER_TIMEOUT:-180}
 
-exec gunicorn chatgpt_ui_server.wsgi --workers=$WORKERS --timeout $TIMEOUT --bind 0.0.0.0:8000 --access-logfile -
\ No newline at end of file
+exec gunicorn chatgpt_ui_server.asgi --worker-class uvicorn.workers.UvicornWorker --workers=$WORKERS --timeout $TIMEOUT --bind 0.0.0.0:8000 --access-logfile -
\ No newline at end of file
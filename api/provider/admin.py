@@ -6,7 +6,7 @@ from .models import ApiKey
 
 @admin.register(ApiKey)
 class ApiKeyAdmin(admin.ModelAdmin):
-    list_display = ('key', 'token_used', 'remark', 'is_enabled', 'created_at')
+    list_display = ('key', 'token_used', 'remark', 'is_enabled', 'requests_per_minute', 'created_at')
 
     formfield_overrides = {
         BooleanField: {'widget': CheckboxInput},
@@ -6,6 +6,7 @@ class ApiKey(models.Model):
     token_used = models.IntegerField(default=0)
     remark = models.CharField(max_length=255)
     is_enabled = models.BooleanField(default=True)
+    requests_per_minute = models.IntegerField(default=0)  # 0 is settings.API_KEY_REQUESTS_PER_MINUTE
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
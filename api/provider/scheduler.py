@@ -0,0 +1,168 @@
+"""
+In-process scheduler balancing requests over the enabled API keys
+"""
+import time
+import uuid
+import atexit
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from .models import ApiKey
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'provider:api_keys_version'
+VERSION_CHECK_SECONDS = 5
+
+
+class _KeyState:
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.outstanding = 0
+        self.pending_tokens = 0
+        self.cooldown_until = 0.0
+        self.started = deque()  # request start times of the last minute
+
+    def requests_per_minute(self, default):
+        return self.api_key.requests_per_minute or default
+
+
+class ApiKeyScheduler:
+    """least-outstanding-requests balancing with per-key rate limits and cooldowns
+
+    The rate limit of a key is its requests_per_minute, or the scheduler's one
+    when the key has none.
+
+    Keys are reloaded from the database every refresh_seconds, or sooner when
+    an ApiKey changed: every process compares the version of the keys in the
+    shared cache every VERSION_CHECK_SECONDS. Token usage is counted in memory
+    and written back with atomic F() updates on refresh, so concurrent requests
+    neither pick the same key nor lose increments.
+    """
+
+    def __init__(self, requests_per_minute=0, cooldown_seconds=60, refresh_seconds=30):
+        self.requests_per_minute = requests_per_minute
+        self.cooldown_seconds = cooldown_seconds
+        self.refresh_seconds = refresh_seconds
+        self._states = {}
+        self._refreshed_at = None
+        self._checked_at = 0.0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _due(self, now):
+        if self._refreshed_at is None or now - self._refreshed_at >= self.refresh_seconds:
+            return True
+        if now - self._checked_at < VERSION_CHECK_SECONDS:
+            return False
+        self._checked_at = now
+        return cache.get(VERSION_KEY) != self._version
+
+    def _refresh(self, now):
+        with self._lock:
+            if not self._due(now):
+                return
+            self._refreshed_at = now
+            self._checked_at = now
+            self._version = cache.get(VERSION_KEY)
+        self.flush()
+        api_keys = list(ApiKey.objects.filter(is_enabled=True))
+        with self._lock:
+            states = {}
+            for api_key in api_keys:
+                state = self._states.pop(api_key.pk, None) or _KeyState(api_key)
+                api_key.token_used += state.pending_tokens
+                state.api_key = api_key
+                states[api_key.pk] = state
+            removed, self._states = self._states, states
+        for state in removed.values():  # disabled or deleted keys
+            self._write_tokens(state.api_key.pk, state.pending_tokens)
+
+    def acquire(self):
+        """return the least busy key that is not cooling down or rate limited, or None"""
+        now = time.monotonic()
+        self._refresh(now)
+        with self._lock:
+            best = None
+            for state in self._states.values():
+                if state.cooldown_until > now:
+                    continue
+                while state.started and now - state.started[0] > 60:
+                    state.started.popleft()
+                limit = state.requests_per_minute(self.requests_per_minute)
+                if limit and len(state.started) >= limit:
+                    continue
+                if best is None or (state.outstanding, state.api_key.token_used) < (best.outstanding, best.api_key.token_used):
+                    best = state
+            if best is None:
+                return None
+            best.outstanding += 1
+            best.started.append(now)
+            return best.api_key
+
+    def release(self, api_key):
+        if api_key is None:
+            return
+        with self._lock:
+            state = self._states.get(api_key.pk)
+            if state and state.outstanding > 0:
+                state.outstanding -= 1
+
+    def add_tokens(self, api_key, tokens):
+        with self._lock:
+            state = self._states.get(api_key.pk)
+            if state:
+                state.pending_tokens += tokens
+                state.api_key.token_used += tokens
+                return
+        self._write_tokens(api_key.pk, tokens)
+
+    def cooldown(self, api_key, seconds=None):
+        """stop picking a key that was rate limited upstream"""
+        if api_key is None:
+            return
+        logger.warning('api key %s is rate limited, cooling down', api_key.pk)
+        with self._lock:
+            state = self._states.get(api_key.pk)
+            if state:
+                state.cooldown_until = time.monotonic() + (seconds or self.cooldown_seconds)
+
+    def invalidate(self):
+        """reload the keys on the next acquire, in every process"""
+        with self._lock:
+            self._refreshed_at = None
+        cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+    def flush(self):
+        """write the token usage counted since the last flush"""
+        with self._lock:
+            pending = {pk: state.pending_tokens for pk, state in self._states.items() if state.pending_tokens}
+            for pk in pending:
+                self._states[pk].pending_tokens = 0
+        for pk, tokens in pending.items():
+            self._write_tokens(pk, tokens)
+
+    @staticmethod
+    def _write_tokens(pk, tokens):
+        if tokens:
+            ApiKey.objects.filter(pk=pk).update(token_used=F('token_used') + tokens)
+
+
+api_key_scheduler = ApiKeyScheduler(
+    requests_per_minute=settings.API_KEY_REQUESTS_PER_MINUTE,
+    cooldown_seconds=settings.API_KEY_COOLDOWN_SECONDS,
+    refresh_seconds=settings.API_KEY_REFRESH_SECONDS,
+)
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        api_key_scheduler.flush()
+    except Exception as e:
+        logger.error('cannot flush api key usage %s', e)
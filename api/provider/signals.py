@@ -0,0 +1,11 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import ApiKey
+from .scheduler import api_key_scheduler
+
+
+@receiver(post_save, sender=ApiKey)
+@receiver(post_delete, sender=ApiKey)
+def invalidate_api_keys(sender, **kwargs):
+    transaction.on_commit(api_key_scheduler.invalidate)
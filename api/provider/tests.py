@@ -1,3 +1,85 @@
+from unittest import mock
+
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from .models import ApiKey
+from .scheduler import ApiKeyScheduler
+
+
+class ApiKeySchedulerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.first = ApiKey.objects.create(key='sk-first', remark='first', token_used=10)
+        self.second = ApiKey.objects.create(key='sk-second', remark='second', token_used=20)
+        ApiKey.objects.create(key='sk-disabled', remark='disabled', is_enabled=False)
+        self.scheduler = ApiKeyScheduler()
+
+    def test_picks_least_busy_key(self):
+        picked = [self.scheduler.acquire().pk for _ in range(4)]
+        # ties on outstanding requests go to the key with the fewest tokens used
+        self.assertEqual(picked, [self.first.pk, self.second.pk, self.first.pk, self.second.pk])
+
+    def test_released_key_is_picked_again(self):
+        first = self.scheduler.acquire()
+        self.scheduler.acquire()
+        self.scheduler.release(first)
+        self.assertEqual(self.scheduler.acquire().pk, first.pk)
+
+    def test_disabled_keys_are_not_picked(self):
+        picked = {self.scheduler.acquire().pk for _ in range(10)}
+        self.assertEqual(picked, {self.first.pk, self.second.pk})
+
+    def test_key_cooling_down_is_skipped(self):
+        self.scheduler.cooldown(self.scheduler.acquire())
+        self.assertEqual(self.scheduler.acquire().pk, self.second.pk)
+        self.assertEqual(self.scheduler.acquire().pk, self.second.pk)
+
+    def test_rate_limit_per_key(self):
+        ApiKey.objects.filter(pk=self.first.pk).update(requests_per_minute=1)
+        scheduler = ApiKeyScheduler(requests_per_minute=2)
+        picked = [api_key.pk if api_key else None for api_key in (scheduler.acquire() for _ in range(4))]
+        self.assertEqual(picked.count(self.first.pk), 1)
+        self.assertEqual(picked.count(self.second.pk), 2)
+        self.assertIsNone(picked[-1])
+
+    def test_rate_limit_window_slides(self):
+        scheduler = ApiKeyScheduler(requests_per_minute=1)
+        with mock.patch('provider.scheduler.time.monotonic', return_value=1000.0):
+            scheduler.acquire()
+            scheduler.acquire()
+            self.assertIsNone(scheduler.acquire())
+        with mock.patch('provider.scheduler.time.monotonic', return_value=1061.0):
+            self.assertIsNotNone(scheduler.acquire())
+
+    def test_tokens_are_flushed_with_f_updates(self):
+        api_key = self.scheduler.acquire()
+        self.scheduler.add_tokens(api_key, 5)
+        self.scheduler.add_tokens(api_key, 7)
+        self.assertEqual(ApiKey.objects.get(pk=api_key.pk).token_used, 10)
+        # a write made meanwhile by another process is kept
+        ApiKey.objects.filter(pk=api_key.pk).update(token_used=100)
+        self.scheduler.flush()
+        self.assertEqual(ApiKey.objects.get(pk=api_key.pk).token_used, 112)
+        self.scheduler.flush()
+        self.assertEqual(ApiKey.objects.get(pk=api_key.pk).token_used, 112)
+
+    def test_tokens_of_unknown_key_are_written_at_once(self):
+        self.scheduler.add_tokens(self.first, 3)
+        self.assertEqual(ApiKey.objects.get(pk=self.first.pk).token_used, 13)
+
+    def test_invalidate_reloads_keys(self):
+        self.scheduler.acquire()
+        ApiKey.objects.filter(pk=self.second.pk).update(is_enabled=False)
+        self.scheduler.invalidate()
+        picked = {self.scheduler.acquire().pk for _ in range(3)}
+        self.assertEqual(picked, {self.first.pk})
+
+    def test_pending_tokens_of_removed_key_are_written(self):
+        api_key = self.scheduler.acquire()
+        self.scheduler.add_tokens(api_key, 4)
+        ApiKey.objects.filter(pk=api_key.pk).update(is_enabled=False)
+        self.scheduler.invalidate()
+        self.scheduler.acquire()
+        self.assertEqual(ApiKey.objects.get(pk=api_key.pk).token_used, 14)
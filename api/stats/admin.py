@@ -1,9 +1,21 @@
 from django.contrib import admin
 
 
-from .models import TokenUsage
+from .models import TokenUsage, PhaseTiming, UsageRollup
 
 
 @admin.register(TokenUsage)
 class TokenUsageAdmin(admin.ModelAdmin):
     list_display = ('user', 'tokens')
+
+
+@admin.register(PhaseTiming)
+class PhaseTimingAdmin(admin.ModelAdmin):
+    list_display = ('bucket', 'path', 'phase', 'count', 'total_ms', 'max_ms')
+    list_filter = ('path', 'phase')
+
+
+@admin.register(UsageRollup)
+class UsageRollupAdmin(admin.ModelAdmin):
+    list_display = ('bucket', 'user', 'api_key', 'model', 'requests', 'prompt_tokens', 'completion_tokens')
+    list_filter = ('model',)
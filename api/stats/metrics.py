@@ -0,0 +1,178 @@
+"""
+Per-request timing of the chat paths
+
+A RequestTimer collects the duration of each phase of a request. Finished
+timers feed in-process Prometheus histograms and hourly PhaseTiming
+aggregates, which are written to the database in batches.
+"""
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import PhaseTiming
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 30, 40, 50, 75, 100, 150, 200)
+FLUSH_SECONDS = 30
+
+_current_timer = contextvars.ContextVar('current_request_timer', default=None)
+
+
+class RequestTimer:
+    """durations of the phases of one request, in seconds"""
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.tokens = 0
+        _current_timer.set(self)
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def since_start(self, name):
+        """record the time elapsed since the request started"""
+        self.phases[name] = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """the Server-Timing header value of the phases recorded so far"""
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.phases.items())
+
+    def tokens_per_second(self):
+        generation = self.phases.get('generation')
+        if self.tokens and generation:
+            return self.tokens / generation
+        return None
+
+    def finish(self):
+        self.since_start('total')
+        for name, seconds in self.phases.items():
+            phase_seconds.observe((self.path, name), seconds)
+            aggregates.add(self.path, name, seconds)
+        rate = self.tokens_per_second()
+        if rate is not None:
+            tokens_per_second.observe((self.path,), rate)
+        logger.debug('request timing %s %s %s tokens/s', self.path, self.server_timing(), rate)
+
+
+@contextmanager
+def timed(name):
+    """time a phase of the current request, if there is one"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+class Histogram:
+    """a Prometheus histogram with labels, kept in process memory"""
+
+    def __init__(self, name, documentation, labels, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.setdefault(label_values, [[0] * (len(self.buckets) + 1), 0.0])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {key: ([*counts], total) for key, (counts, total) in self._series.items()}
+        for label_values, (counts, total) in series.items():
+            labels = ','.join(f'{label}="{value}"' for label, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines)
+
+
+phase_seconds = Histogram('chat_request_phase_seconds', 'Duration of the phases of chat requests.', ('path', 'phase'))
+tokens_per_second = Histogram('chat_tokens_per_second', 'Completion tokens streamed per second.', ('path',), TOKENS_PER_SECOND_BUCKETS)
+HISTOGRAMS = (phase_seconds, tokens_per_second)
+
+
+class PhaseAggregates:
+    """hourly phase timings, buffered in memory and flushed every FLUSH_SECONDS"""
+
+    def __init__(self):
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, path, phase, seconds):
+        bucket = timezone.now().replace(minute=0, second=0, microsecond=0)
+        milliseconds = seconds * 1000
+        with self._lock:
+            entry = self._pending.setdefault((bucket, path, phase), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += milliseconds
+            entry[2] = max(entry[2], milliseconds)
+
+    def flush_due(self):
+        if time.monotonic() - self._flushed_at >= FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.monotonic()
+        for (bucket, path, phase), (count, total_ms, max_ms) in pending.items():
+            try:
+                self._upsert(bucket, path, phase, count, total_ms, max_ms)
+            except Exception as e:
+                logger.error('cannot store phase timing %s %s', phase, e)
+
+    @staticmethod
+    def _upsert(bucket, path, phase, count, total_ms, max_ms):
+        rows = PhaseTiming.objects.filter(bucket=bucket, path=path, phase=phase)
+        update = {
+            'count': F('count') + count,
+            'total_ms': F('total_ms') + total_ms,
+            'max_ms': Greatest(F('max_ms'), max_ms),
+        }
+        if rows.update(**update):
+            return
+        try:
+            with transaction.atomic():
+                PhaseTiming.objects.create(bucket=bucket, path=path, phase=phase, count=count, total_ms=total_ms, max_ms=max_ms)
+        except IntegrityError:  # created by another process meanwhile
+            rows.update(**update)
+
+
+aggregates = PhaseAggregates()
+
+
+def expose_metrics():
+    """all the histograms in the Prometheus text format"""
+    return '\n'.join(histogram.expose() for histogram in HISTOGRAMS) + '\n'
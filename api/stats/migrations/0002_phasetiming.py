@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stats', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhaseTiming',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('path', models.CharField(max_length=64)),
+                ('phase', models.CharField(max_length=64)),
+                ('count', models.IntegerField(default=0)),
+                ('total_ms', models.FloatField(default=0)),
+                ('max_ms', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='phasetiming',
+            constraint=models.UniqueConstraint(fields=('bucket', 'path', 'phase'), name='stats_phase_timing_unique'),
+        ),
+    ]
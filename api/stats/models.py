@@ -5,3 +5,54 @@ from django.contrib.auth.models import User
 class TokenUsage(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     tokens = models.IntegerField(default=0)
+
+
+class PhaseTiming(models.Model):
+    """hourly aggregate of the duration of one phase of a request path"""
+    bucket = models.DateTimeField()
+    path = models.CharField(max_length=64)
+    phase = models.CharField(max_length=64)
+    count = models.IntegerField(default=0)
+    total_ms = models.FloatField(default=0)
+    max_ms = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'path', 'phase'], name='stats_phase_timing_unique'),
+        ]
+
+
+class UsageRecord(models.Model):
+    """one billed LLM call, append-only"""
+    created_at = models.DateTimeField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    api_key = models.ForeignKey('provider.ApiKey', on_delete=models.SET_NULL, null=True, blank=True)
+    model = models.CharField(max_length=64)
+    prompt_tokens = models.IntegerField(default=0)
+    completion_tokens = models.IntegerField(default=0)
+    latency_ms = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='stats_usage_user_created_idx'),
+        ]
+
+
+class UsageRollup(models.Model):
+    """hourly totals of the usage records, what period queries read"""
+    bucket = models.DateTimeField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    api_key = models.ForeignKey('provider.ApiKey', on_delete=models.SET_NULL, null=True, blank=True)
+    model = models.CharField(max_length=64)
+    requests = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    total_latency_ms = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'user', 'api_key', 'model'], name='stats_usage_rollup_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['bucket'], name='stats_usage_rollup_bucket_idx'),
+        ]
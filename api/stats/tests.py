@@ -1,3 +1,126 @@
+import datetime
+from unittest import mock
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from provider.models import ApiKey
+from .models import TokenUsage, UsageRecord, UsageRollup
+from .usage import UsageWriter, increase_token_usage, usage_by_period
+
+UTC = datetime.timezone.utc
+
+
+class UsageTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.api_key = ApiKey.objects.create(key='sk-test', remark='test')
+        self.writer = UsageWriter()
+
+    def record(self, at, user, model='gpt-3.5-turbo', prompt_tokens=10, completion_tokens=5, api_key=None):
+        with mock.patch('stats.usage.timezone.now', return_value=at):
+            self.writer.record(user, model, prompt_tokens, completion_tokens, latency_ms=100, api_key=api_key)
+
+    def test_records_are_rolled_up_per_hour(self):
+        self.record(datetime.datetime(2023, 7, 1, 10, 5, tzinfo=UTC), self.alice)
+        self.record(datetime.datetime(2023, 7, 1, 10, 55, tzinfo=UTC), self.alice)
+        self.record(datetime.datetime(2023, 7, 1, 11, 0, tzinfo=UTC), self.alice)
+        self.record(datetime.datetime(2023, 7, 1, 10, 30, tzinfo=UTC), self.alice, api_key=self.api_key)
+        self.assertFalse(UsageRecord.objects.exists())
+        self.writer.flush()
+        self.assertEqual(UsageRecord.objects.count(), 4)
+        rollups = UsageRollup.objects.values_list('bucket', 'api_key', 'requests', 'prompt_tokens', 'total_latency_ms')
+        self.assertCountEqual(rollups, [
+            (datetime.datetime(2023, 7, 1, 10, tzinfo=UTC), None, 2, 20, 200),
+            (datetime.datetime(2023, 7, 1, 10, tzinfo=UTC), self.api_key.pk, 1, 10, 100),
+            (datetime.datetime(2023, 7, 1, 11, tzinfo=UTC), None, 1, 10, 100),
+        ])
+
+    def test_later_flushes_add_to_the_rollup(self):
+        at = datetime.datetime(2023, 7, 1, 10, 5, tzinfo=UTC)
+        self.record(at, self.alice)
+        self.writer.flush()
+        self.record(at, self.alice, completion_tokens=7)
+        self.writer.flush()
+        self.writer.flush()
+        rollup = UsageRollup.objects.get()
+        self.assertEqual((rollup.requests, rollup.prompt_tokens, rollup.completion_tokens), (2, 20, 12))
+
+    def test_flush_due(self):
+        writer = UsageWriter(flush_seconds=3600, flush_records=2)
+        writer.record(self.alice, 'gpt-3.5-turbo')
+        writer.flush_due()
+        self.assertFalse(UsageRecord.objects.exists())
+        writer.record(self.alice, 'gpt-3.5-turbo')
+        writer.flush_due()
+        self.assertEqual(UsageRecord.objects.count(), 2)
+
+    def test_usage_by_period(self):
+        self.record(datetime.datetime(2023, 7, 1, 10, tzinfo=UTC), self.alice)
+        self.record(datetime.datetime(2023, 7, 1, 20, tzinfo=UTC), self.alice, model='gpt-4')
+        self.record(datetime.datetime(2023, 7, 2, 9, tzinfo=UTC), self.bob)
+        self.writer.flush()
+
+        days = usage_by_period('day')
+        self.assertEqual([(row['period'].day, row['requests'], row['prompt_tokens']) for row in days], [(1, 2, 20), (2, 1, 10)])
+
+        by_model = usage_by_period('month', group_by='model')
+        self.assertEqual([(row['group'], row['requests']) for row in by_model], [('gpt-3.5-turbo', 2), ('gpt-4', 1)])
+
+        by_user = usage_by_period('day', group_by='user', user_id=self.alice.pk)
+        self.assertEqual([(row['period'].day, row['group']) for row in by_user], [(1, 'alice')])
+
+        window = usage_by_period(
+            'hour', start=datetime.datetime(2023, 7, 1, 12, tzinfo=UTC), end=datetime.datetime(2023, 7, 2, 9, tzinfo=UTC),
+        )
+        self.assertEqual([row['period'].hour for row in window], [20])
+
+    def test_increase_token_usage(self):
+        increase_token_usage(self.alice, 10)
+        increase_token_usage(self.alice, 5)
+        self.assertEqual(TokenUsage.objects.get(user=self.alice).tokens, 15)
+        with mock.patch('stats.usage.api_key_scheduler') as scheduler:
+            increase_token_usage(self.bob, 3, self.api_key)
+        scheduler.add_tokens.assert_called_once_with(self.api_key, 3)
+        self.assertEqual(TokenUsage.objects.get(user=self.bob).tokens, 3)
+
+
+class UsageEndpointTests(TestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create_user('admin', password='secret', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        writer = UsageWriter()
+        with mock.patch('stats.usage.timezone.now', return_value=datetime.datetime(2023, 7, 1, 10, tzinfo=UTC)):
+            writer.record(self.admin, 'gpt-3.5-turbo', 10, 5)
+        writer.flush()
+
+    def test_usage(self):
+        response = self.client.get('/api/stats/usage/', {'period': 'day', 'group_by': 'model', 'start': '2023-07-01T00:00Z'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['group'], row['requests']) for row in response.data], [('gpt-3.5-turbo', 1)])
+        response = self.client.get('/api/stats/usage/', {'user': str(self.admin.pk + 1)})
+        self.assertEqual(response.data, [])
+
+    def test_admins_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('alice', password='secret'))
+        self.assertEqual(client.get('/api/stats/usage/').status_code, 403)
 
-# Create your tests here.
+    def test_invalid_parameters(self):
+        for params in (
+            {'period': 'decade'},
+            {'group_by': 'color'},
+            {'user': 'alice'},
+            {'api_key': '1 OR 1=1'},
+            {'start': 'yesterday'},
+            {'end': '2023-13-01T00:00Z'},
+        ):
+            with self.subTest(params=params):
+                response = self.client.get('/api/stats/usage/', params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.data)
@@ -0,0 +1,157 @@
+"""
+Token usage ledger
+
+Every billed LLM call is appended to UsageRecord and added to the hourly
+UsageRollup totals. Calls are buffered in memory and written in batches, so
+the chat paths never wait on the ledger.
+"""
+import time
+import atexit
+import logging
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from provider.scheduler import api_key_scheduler
+from .models import TokenUsage, UsageRecord, UsageRollup
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SECONDS = 10
+FLUSH_RECORDS = 500
+
+PERIODS = {
+    'hour': TruncHour,
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
+GROUPS = {
+    'user': 'user__username',
+    'api_key': 'api_key__remark',
+    'model': 'model',
+}
+
+
+class UsageWriter:
+    """buffer usage records and write them, with their rollups, in batches"""
+
+    def __init__(self, flush_seconds=FLUSH_SECONDS, flush_records=FLUSH_RECORDS):
+        self.flush_seconds = flush_seconds
+        self.flush_records = flush_records
+        self._pending = []
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, user, model, prompt_tokens=0, completion_tokens=0, latency_ms=0, api_key=None):
+        with self._lock:
+            self._pending.append(UsageRecord(
+                created_at=timezone.now(),
+                user_id=user.pk,
+                api_key_id=api_key.pk if api_key else None,
+                model=model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                latency_ms=latency_ms,
+            ))
+
+    def flush_due(self):
+        if len(self._pending) >= self.flush_records or time.monotonic() - self._flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+
+        rollups = {}
+        for record in pending:
+            bucket = record.created_at.replace(minute=0, second=0, microsecond=0)
+            rollup = rollups.setdefault((bucket, record.user_id, record.api_key_id, record.model), [0, 0, 0, 0.0])
+            rollup[0] += 1
+            rollup[1] += record.prompt_tokens
+            rollup[2] += record.completion_tokens
+            rollup[3] += record.latency_ms
+
+        try:
+            with transaction.atomic():
+                UsageRecord.objects.bulk_create(pending)
+                for key, totals in rollups.items():
+                    self._add_rollup(*key, *totals)
+        except Exception as e:
+            logger.error('cannot write %d usage records %s', len(pending), e)
+
+    @staticmethod
+    def _add_rollup(bucket, user_id, api_key_id, model, requests, prompt_tokens, completion_tokens, latency_ms):
+        rows = UsageRollup.objects.filter(bucket=bucket, user_id=user_id, api_key_id=api_key_id, model=model)
+        update = {
+            'requests': F('requests') + requests,
+            'prompt_tokens': F('prompt_tokens') + prompt_tokens,
+            'completion_tokens': F('completion_tokens') + completion_tokens,
+            'total_latency_ms': F('total_latency_ms') + latency_ms,
+        }
+        if rows.update(**update):
+            return
+        try:
+            with transaction.atomic():
+                UsageRollup.objects.create(
+                    bucket=bucket, user_id=user_id, api_key_id=api_key_id, model=model, requests=requests,
+                    prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_latency_ms=latency_ms,
+                )
+        except IntegrityError:  # created by another process meanwhile
+            rows.update(**update)
+
+
+usage_writer = UsageWriter()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        usage_writer.flush()
+    except Exception as e:
+        logger.error('cannot flush usage records %s', e)
+
+
+def increase_token_usage(user, tokens, api_key=None):
+    """add tokens to the running total of a user, and of the api key they were billed to"""
+    with transaction.atomic():
+        if not TokenUsage.objects.filter(user=user).update(tokens=F('tokens') + tokens):
+            token_usage, created = TokenUsage.objects.get_or_create(user=user)
+            TokenUsage.objects.filter(pk=token_usage.pk).update(tokens=F('tokens') + tokens)
+
+    if api_key:
+        api_key_scheduler.add_tokens(api_key, tokens)
+
+
+def usage_by_period(period='day', start=None, end=None, group_by=None, **filters):
+    """sum the hourly rollups per period, optionally split by user, api_key or model
+
+    The cost depends on the number of hourly buckets in the range, not on the
+    number of messages.
+    """
+    queryset = UsageRollup.objects.filter(**filters)
+    if start:
+        queryset = queryset.filter(bucket__gte=start)
+    if end:
+        queryset = queryset.filter(bucket__lt=end)
+    fields = ['period']
+    if group_by:
+        queryset = queryset.annotate(group=F(GROUPS[group_by]))
+        fields.append('group')
+    return list(
+        queryset.annotate(period=PERIODS[period]('bucket'))
+        .values(*fields)
+        .annotate(
+            requests=Sum('requests'),
+            prompt_tokens=Sum('prompt_tokens'),
+            completion_tokens=Sum('completion_tokens'),
+            total_latency_ms=Sum('total_latency_ms'),
+        )
+        .order_by(*fields)
+    )
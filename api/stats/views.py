@@ -1,3 +1,53 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.dateparse import parse_datetime
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
 
-# Create your views here.
+from .metrics import expose_metrics
+from .usage import usage_by_period, PERIODS, GROUPS
+
+
+def metrics(request):
+    """Prometheus scrape endpoint of this process"""
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(expose_metrics(), content_type='text/plain; version=0.0.4')
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def usage(request):
+    """token usage per period, e.g. ?period=day&start=2023-07-01T00:00Z&group_by=model"""
+    period = request.query_params.get('period', 'day')
+    group_by = request.query_params.get('group_by')
+    if period not in PERIODS or (group_by and group_by not in GROUPS):
+        return Response(
+            {'error': f'period is one of {list(PERIODS)}, group_by one of {list(GROUPS)}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    filters = {}
+    for name in ('user', 'api_key'):
+        value = request.query_params.get(name)
+        if value:
+            try:
+                filters[f'{name}_id'] = int(value)
+            except ValueError:
+                return Response({'error': f'{name} is an id'}, status=status.HTTP_400_BAD_REQUEST)
+    bounds = {}
+    for name in ('start', 'end'):
+        value = request.query_params.get(name)
+        if value:
+            try:
+                bounds[name] = parse_datetime(value)
+            except ValueError:
+                bounds[name] = None
+            if bounds[name] is None:
+                return Response(
+                    {'error': f'{name} is an ISO 8601 datetime, e.g. 2023-07-01T00:00Z'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+    return Response(usage_by_period(period, group_by=group_by, **bounds, **filters))
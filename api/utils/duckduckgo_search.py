@@ -1,6 +1,10 @@
+import hashlib
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from bs4 import BeautifulSoup
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
 from .search_abc import SearchRequest, SearchResponse, SearchResult
 
 import os
@@ -16,6 +20,16 @@ for key in ['DUCK_PROXY', 'http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROX
 
 
 BASE_URL = 'https://lite.duckduckgo.com'
+TIMEOUT = (3.05, float(os.getenv('WEB_SEARCH_TIMEOUT', 10)))  # (connect, read) seconds
+CACHE_SECONDS = int(os.getenv('WEB_SEARCH_CACHE_SECONDS', 600))
+FETCH_PAGES = int(os.getenv('WEB_SEARCH_FETCH_PAGES', 0))  # result pages fetched to enrich snippets
+PAGE_EXCERPT_CHARS = 1000
+
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+if proxies:
+    session.proxies.update(proxies)
 
 
 def get_html(search: SearchRequest) -> SearchResponse:
@@ -31,7 +45,7 @@ def get_html(search: SearchRequest) -> SearchResponse:
         'df': search.timerange,
         'kl': search.region,
     }
-    response = requests.post(f'{BASE_URL}/lite/', headers=headers, data=data, proxies=proxies)
+    response = session.post(f'{BASE_URL}/lite/', headers=headers, data=data, timeout=TIMEOUT)
     if not response.ok:
         raise Exception(f'Failed to fetch: {response.status_code} {response.reason}')
     return SearchResponse(response.status_code, response.text, response.url)
@@ -57,9 +71,46 @@ def html_to_search_results(html: str, num_results: int) -> List[SearchResult]:
     return results
 
 
-def web_search(search: SearchRequest, num_results: int) -> List[SearchResult]:
+def fetch_page_excerpt(url: str, ua: str = None) -> str:
+    """return the beginning of the visible text of a page, or '' if it cannot be fetched"""
+    try:
+        response = session.get(url, headers={'User-Agent': ua}, timeout=TIMEOUT)
+        if not response.ok or 'html' not in response.headers.get('Content-Type', ''):
+            return ''
+        soup = BeautifulSoup(response.text, 'html.parser')
+        for tag in soup(['script', 'style', 'noscript']):
+            tag.decompose()
+        return ' '.join(soup.get_text(' ').split())[:PAGE_EXCERPT_CHARS]
+    except requests.RequestException:
+        return ''
+
+
+def enrich_search_results(results: List[SearchResult], ua: str = None, top_k: int = FETCH_PAGES) -> List[SearchResult]:
+    """append an excerpt of the top_k result pages to their snippets, fetched concurrently"""
+    top = results[:top_k]
+    if not top:
+        return results
+    with ThreadPoolExecutor(max_workers=len(top)) as executor:
+        excerpts = list(executor.map(lambda result: fetch_page_excerpt(result.url, ua), top))
+    for result, excerpt in zip(top, excerpts):
+        if excerpt:
+            result.body = f'{result.body}\n{excerpt}'
+    return results
+
+
+def web_search(search: SearchRequest, num_results: int, fetch_pages: int = FETCH_PAGES) -> List[SearchResult]:
+    key = hashlib.sha256(repr((search.query, search.region, search.timerange, num_results, fetch_pages)).encode()).hexdigest()
+    cache_key = f'web_search:{key}'
+    results = cache.get(cache_key)
+    if results is not None:
+        return results
+
     response = get_html(search)
     if response.url == f'{BASE_URL}/lite/':
-        return html_to_search_results(response.html, num_results)
+        results = html_to_search_results(response.html, num_results)
     else:
         raise Exception(f'Unexpected redirect: {response.url}')
+    if fetch_pages:
+        results = enrich_search_results(results, search.ua, fetch_pages)
+    cache.set(cache_key, results, CACHE_SECONDS)
+    return results
@@ -9,12 +9,43 @@ export const getDefaultConversationData = () => {
     }
 }
 
-export const getConversations = async () => {
-    const { data, error } = await useAuthFetch('/api/chat/conversations/')
+export const getConversations = async (url = '/api/chat/conversations/') => {
+    const { data, error } = await useAuthFetch(url)
     if (!error.value) {
         return data.value
     }
-    return []
+    return { next: null, results: [] }
+}
+
+export const getMessages = async (conversationId) => {
+    let url = `/api/chat/messages/?conversationId=${conversationId}`
+    const messages = []
+    while (url) {
+        const { data, error } = await useAuthFetch(url)
+        if (error.value) {
+            return null
+        }
+        messages.push(...data.value.results)
+        url = data.value.next
+    }
+    return messages
+}
+
+export const waitForJob = async (jobId, interval = 1000) => {
+    while (true) {
+        const { data, error } = await useAuthFetch(`/api/jobs/${jobId}/`, { key: `${jobId}-${Date.now()}` })
+        if (error.value) {
+            if (error.value.statusCode === 404) {
+                // expired or never known, it may have completed
+                return { status: 'unknown' }
+            }
+            return { status: 'failed', error: error.value.message }
+        }
+        if (data.value.status === 'done' || data.value.status === 'failed') {
+            return data.value
+        }
+        await new Promise(resolve => setTimeout(resolve, interval))
+    }
 }
 
 export const addConversation = (conversation) => {
@@ -35,17 +66,21 @@ export const genTitle = async (conversationId) => {
         }
     })
     if (!error.value) {
-        const conversations = useConversations()
-        let index = conversations.value.findIndex(item => item.id === conversationId)
-        if (index === -1) {
-            index = 0
-        }
-        conversations.value[index].topic = data.value.title
+        setConversationTitle(conversationId, data.value.title)
         return data.value.title
     }
     return null
 }
 
+export const setConversationTitle = (conversationId, title) => {
+    const conversations = useConversations()
+    let index = conversations.value.findIndex(item => item.id === conversationId)
+    if (index === -1) {
+        index = 0
+    }
+    conversations.value[index].topic = title
+}
+
 export const fetchUser = async () => {
     return useMyFetch('/api/account/user/')
 }